@@ -0,0 +1,108 @@
+"""Benchmark of the browser profiles: page capture time and Chrome memory.
+
+Logs in with each profile in turn, opens the same files tab pages one at a
+time, and times loading each page and reading its html. The Chrome memory
+(RSS, read from /proc so Linux only) is sampled after each page.
+
+Usage Example:
+    python3 benchmark_browser.py --table_config quotes --count 20
+    python3 benchmark_browser.py --table_config quotes --profiles headed headless
+"""
+
+import argparse
+import statistics
+import time
+
+import file_download as fd
+import scrape_tools as st
+
+
+def get_benchmark_urls(count):
+    """Gets the files tab urls of the first `count` links in 'links.csv'."""
+    if "{id_2}" in fd.CONFIG.table.files_table_url_form:
+        fd.__load_secondary_reference()  # pylint: disable=W0212
+    urls = []
+    for link in fd.read_links_from_file():
+        files_url = fd.get_files_url(link)
+        if files_url:
+            urls.append(files_url)
+        if len(urls) >= count:
+            break
+    return urls
+
+
+def benchmark_profile(profile, urls):
+    """Captures the pages with one browser profile.
+
+    Returns:
+        dict: The profile, the mean and median seconds per page, and the mean
+            and peak Chrome memory in MB.
+    """
+    st.start_browser(profile)
+    st.open_connection(st.logons[fd.CONFIG.get_logon_id()])
+    times = []
+    rss_samples = []
+    for url in urls:
+        start_time = time.time()
+        st.driver.get(url)
+        html_content = st.driver.page_source
+        times.append(time.time() - start_time)
+        rss_samples.append(st.get_browser_rss() / 1024 / 1024)
+        print(f"{profile}: {len(html_content)} chars in {times[-1]:.2f} s: {url}")
+    st.driver.quit()
+    st.driver = None
+
+    return {
+        "profile": profile,
+        "mean_time": statistics.mean(times),
+        "median_time": statistics.median(times),
+        "mean_rss": statistics.mean(rss_samples),
+        "peak_rss": max(rss_samples),
+    }
+
+
+def print_results(results):
+    """Prints the results as a table."""
+    print(
+        f"\n{'Profile':<10} {'Mean s/page':>12} {'Median s/page':>14} "
+        f"{'Mean MB':>9} {'Peak MB':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['profile']:<10} {result['mean_time']:>12.2f} "
+            f"{result['median_time']:>14.2f} {result['mean_rss']:>9.0f} "
+            f"{result['peak_rss']:>9.0f}"
+        )
+
+
+def main():
+    """Runs the benchmark for each profile."""
+    parser = argparse.ArgumentParser(description="Benchmark the browser profiles.")
+    parser.add_argument(
+        "--table_config", type=str, required=True, help="Table configuration name."
+    )
+    parser.add_argument(
+        "--logon_id", type=int, default=0, help="The logon ID. (0 = IBS, 1 = DSI)"
+    )
+    parser.add_argument(
+        "--count", type=int, default=20, help="Number of pages from links.csv."
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=list(st.BROWSER_PROFILES),
+        choices=list(st.BROWSER_PROFILES),
+        help="The profiles to compare.",
+    )
+    args = parser.parse_args()
+
+    fd.set_table_config(args.table_config)
+    fd.CONFIG.set_logon_id(args.logon_id)
+    st.current_logon = st.logons[args.logon_id]  # For the full page urls.
+    urls = get_benchmark_urls(args.count)
+    print(f"Benchmarking {len(urls)} pages with profiles: {args.profiles}")
+    print_results([benchmark_profile(profile, urls) for profile in args.profiles])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Pool of browser worker processes, each logged in with its own browser.
+
+Instead of running several `file_download_main.py` processes by hand with
+different --start_num / --end_num, the pool starts N worker processes that take
+items from one shared queue, so there are no gaps or overlaps. Each worker
+starts a browser and logs in (see `file_download.start_browser`), then handles
+items until the queue is empty. The results are sent back to the parent and
+merged.
+
+If a worker process dies (eg. Chrome crashed), the item it was working on is
+put back on the queue and a new worker is started in its slot. An item that
+kills workers `MAX_ITEM_ATTEMPTS` times is reported as failed.
+
+Each slot (0 to num_workers - 1) has its own browser profile, saved session
+file and download folder, which the worker started in it reuses.
+
+Tasks:
+- "child_pages": item is [abs_index, displayed_text, url, files_url]. Saves the
+    files tab html, like `file_download.get_child_html_pages`.
+- "downloads": item is [key, [[displayed_text, url], ...]]. Downloads all the
+    files of one key, like `file_download.download_files_from_key`. Items are
+    whole keys, so a key's files are always downloaded by one worker.
+
+Usage Example:
+    >>> settings = PoolSettings("quotes", logon_id=0, browser_profile="headless")
+    >>> results = run_pool("child_pages", items, 4, settings)
+"""
+
+from dataclasses import dataclass
+import multiprocessing
+import queue
+import threading
+import traceback
+
+from selenium.common.exceptions import WebDriverException
+
+MAX_ITEM_ATTEMPTS = 2  # Times an item is tried by a worker that then dies.
+
+
+@dataclass
+class PoolSettings:
+    """The download configuration each worker process sets up.
+
+    Attributes:
+        table_config (str): The table configuration name, eg. 'quotes'.
+        logon_id (int): The logon ID (0 for IBS, 1 for DSI).
+        browser_profile (str): The browser profile, eg. 'headless'.
+        is_debugging (bool): Whether debugging mode is enabled.
+        browser_max_pages (int): Pages after which a worker restarts its browser.
+        browser_max_rss_mb (int): Browser memory (MB) above which it is restarted.
+        use_saved_session (bool): Whether to reuse the saved login session. Each
+            worker slot has its own persistent browser profile and session file.
+        use_page_tables (bool): Whether to read only the files table as JSON.
+        keep_raw_html (bool): Whether to also save the whole page source.
+        use_devtools_downloads (bool): Whether to download through DevTools.
+    """
+
+    table_config: str
+    logon_id: int = 0
+    browser_profile: str = "headed"
+    is_debugging: bool = False
+    browser_max_pages: int = 1000
+    browser_max_rss_mb: int = 2048
+    use_saved_session: bool = False
+    use_page_tables: bool = False
+    keep_raw_html: bool = False
+    use_devtools_downloads: bool = False
+
+
+def run_pool(task, items, num_workers, settings, max_restarts=None):
+    """Runs the items through a pool of browser worker processes.
+
+    Args:
+        task (str): "child_pages" or "downloads".
+        items (list): The items, see the module docstring.
+        num_workers (int): The number of worker processes (browsers).
+        settings (PoolSettings): The configuration for the workers.
+        max_restarts (int, optional): The most workers restarted after a crash.
+            Default is twice num_workers.
+
+    Returns:
+        dict: Item index -> result. The result is [True, value] if the item was
+            done, or [False, error message] if it failed.
+    """
+    if max_restarts is None:
+        max_restarts = num_workers * 2
+    context = multiprocessing.get_context("spawn")  # Chrome does not like fork.
+    task_queue = context.Queue()
+    # A SimpleQueue put is written to the pipe at once, so the messages of a
+    # worker that is killed are not lost. A thread moves them to `messages`.
+    result_queue = context.SimpleQueue()
+    messages = queue.Queue()
+    reader = threading.Thread(
+        target=_read_results, args=(result_queue, messages), daemon=True
+    )
+    reader.start()
+    for index, item in enumerate(items):
+        task_queue.put((index, item))
+
+    workers = {}  # worker_id -> process
+    slots = {}  # worker_id -> its slot, whose profile and folders it uses
+    in_flight = {}  # worker_id -> the item index it is working on
+    attempts = {}  # item index -> times started
+    results = {}
+    restarts = 0
+
+    def start_worker(worker_id, slot):
+        process = context.Process(
+            target=_worker_main,
+            args=(worker_id, slot, task, settings, task_queue, result_queue),
+            daemon=True,
+        )
+        process.start()
+        workers[worker_id] = process
+        slots[worker_id] = slot
+
+    next_worker_id = 0
+    for slot in range(min(num_workers, len(items))):
+        start_worker(next_worker_id, slot)
+        next_worker_id += 1
+    print(f"Started {len(workers)} browser workers for {len(items)} items.")
+
+    while len(results) < len(items) and workers:
+        # Find dead workers before reading the queue, so their last messages
+        # are read before their items are put back.
+        dead = [worker_id for worker_id, p in workers.items() if not p.is_alive()]
+        new_messages = []
+        try:
+            new_messages.append(messages.get(timeout=1))
+            while True:
+                new_messages.append(messages.get_nowait())
+        except queue.Empty:
+            pass
+        for kind, worker_id, index, value in new_messages:
+            if kind == "started":
+                in_flight[worker_id] = index
+                attempts[index] = attempts.get(index, 0) + 1
+            else:
+                in_flight.pop(worker_id, None)
+                results[index] = [kind == "done", value]
+                print(f"Worker {worker_id}: item {len(results)}/{len(items)} {kind}.")
+
+        for worker_id in dead:
+            exit_code = workers.pop(worker_id).exitcode
+            index = in_flight.pop(worker_id, None)
+            print(f"Worker {worker_id} stopped (exit code {exit_code}).")
+            if index is not None and index not in results:
+                if attempts[index] >= MAX_ITEM_ATTEMPTS:
+                    results[index] = [False, "Worker crashed on this item."]
+                else:
+                    print(f"Requeueing item {index} of worker {worker_id}.")
+                    task_queue.put((index, items[index]))
+            if exit_code != 0 and restarts < max_restarts:
+                restarts += 1
+                start_worker(next_worker_id, slots[worker_id])
+                next_worker_id += 1
+
+    for _ in workers:
+        task_queue.put(None)  # Tells a worker to quit.
+    for process in workers.values():
+        process.join(timeout=60)
+    result_queue.put(None)  # Stops the reader thread.
+    reader.join()
+
+    for index in range(len(items)):
+        if index not in results:
+            results[index] = [False, "Not done, all the workers stopped."]
+    return results
+
+
+def _read_results(result_queue, messages):
+    """Moves the worker messages to a local queue, which can be read with a timeout."""
+    while True:
+        message = result_queue.get()
+        if message is None:
+            return
+        messages.put(message)
+
+
+def _worker_main(worker_id, slot, task, settings, task_queue, result_queue):
+    """Runs in each worker process: logs in, then handles items until told to quit.
+
+    The worker uses its slot's browser profile, session file and download
+    folder, so a restarted worker reuses those of the one it replaces.
+    """
+    import file_download as fd  # pylint: disable=C0415
+    import scrape_tools as st  # pylint: disable=C0415
+
+    # The parent empties the shared "downloaded_files/" before the workers start.
+    fd.set_table_config(settings.table_config, delete_downloads=False)
+    fd.set_debug_flag(settings.is_debugging)
+    fd.CONFIG.set_logon_id(settings.logon_id)
+    fd.CONFIG.browser_profile = settings.browser_profile
+    fd.CONFIG.browser_max_pages = settings.browser_max_pages
+    fd.CONFIG.browser_max_rss_mb = settings.browser_max_rss_mb
+    fd.CONFIG.use_saved_session = settings.use_saved_session
+    fd.CONFIG.use_page_tables = settings.use_page_tables
+    fd.CONFIG.keep_raw_html = settings.keep_raw_html
+    fd.CONFIG.use_devtools_downloads = settings.use_devtools_downloads
+    # Chrome can not share a user data dir between browsers, each browser saves
+    # its own session, and downloads into its own folder, so two workers never
+    # take the same file.
+    fd.CONFIG.browser_data_dir += f"worker{slot}/"
+    fd.CONFIG.session_file = fd.CONFIG.session_file.replace(
+        ".json", f"_worker{slot}.json"
+    )
+    fd.CONFIG.browser_download_directory += f"worker{slot}/"
+    fd.start_browser()
+    fd.clean_tabs()
+
+    while True:
+        try:
+            message = task_queue.get(timeout=5)
+        except queue.Empty:
+            continue
+        if message is None:
+            break
+        index, item = message
+        result_queue.put(("started", worker_id, index, None))
+        try:
+            value = _do_item(fd, st, task, item)
+        except WebDriverException:
+            # The browser is broken: exit, so the item is tried by a new worker.
+            traceback.print_exc()
+            raise
+        except Exception as e:  # pylint: disable=W0718
+            traceback.print_exc()
+            result_queue.put(("failed", worker_id, index, str(e)))
+            continue
+        result_queue.put(("done", worker_id, index, value))
+
+    st.driver.quit()
+
+
+def _do_item(fd, st, task, item):
+    """Does one item of the task in the worker's browser."""
+    if task == "child_pages":
+        abs_index, displayed_text, url, files_url = item
+        link = st.LinkDataClass(displayed_text, url)
+
+        def get_html():
+            st.driver.get(files_url)
+            return fd.get_files_tab_html(link, files_url)
+
+        html_content = fd.get_supervisor().run(get_html)
+        print(f"{abs_index}", end=" : ")
+        return fd.save_files_tab_html(link, files_url, html_content)
+    if task == "downloads":
+        key, rows = item
+        links = [st.LinkDataClass(displayed_text, url) for displayed_text, url in rows]
+        fd.resolve_image_redirects({key: links})
+        fd.download_files_from_key(key, links, 1, 1)
+        return len(links)
+    raise ValueError(f"Unknown task: {task}")
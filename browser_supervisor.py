@@ -0,0 +1,171 @@
+"""
+Supervisor that recycles the browser (`st.driver`) during long runs.
+
+After thousands of tabs Chrome's memory grows until it hangs or crashes. The
+supervisor restarts the browser, logs in again with `st.current_logon`, and
+copies the new cookies to the HTTP transport:
+- after `max_pages` pages,
+- when the browser memory is over `max_rss` bytes,
+- when the browser stops responding (a page load or script timeout, or a
+  crashed Chrome), after which the item in flight is tried again.
+
+Usage Example:
+    >>> supervisor = BrowserSupervisor(max_pages=1000)
+    >>> for link in links:
+    ...     supervisor.run(download_link, key, link)
+"""
+
+import os
+import signal
+import threading
+import time
+
+from selenium.common.exceptions import WebDriverException
+
+import scrape_tools as st
+
+logger = st.logger
+
+
+class BrowserSupervisor:
+    """Restarts the browser when it is worn out or stops responding.
+
+    Attributes:
+        max_pages (int): Pages after which the browser is restarted.
+        max_rss (int): Browser memory (bytes) above which it is restarted.
+        page_timeout (float): Seconds a page load or script may take before the
+            browser is taken as not responding.
+        max_restarts (int): The most restarts for one item before giving up.
+        check_interval (float): Seconds between the browser's memory and
+            responsiveness checks in `run`.
+        pages (int): Pages since the last restart.
+        restarts (int): Restarts so far.
+    """
+
+    def __init__(
+        self,
+        max_pages=1000,
+        max_rss=2 * 1024 * 1024 * 1024,
+        page_timeout=120,
+        max_restarts=3,
+        check_interval=10,
+    ):
+        self.max_pages = max_pages
+        self.max_rss = max_rss
+        self.page_timeout = page_timeout
+        self.max_restarts = max_restarts
+        self.check_interval = check_interval
+        self.pages = 0
+        self.restarts = 0
+        self.__last_check = time.time()
+        self.__set_timeouts()
+
+    def run(self, function, *args, **kwargs):
+        """Runs one item that uses the browser, restarting it if needed.
+
+        The browser is first recycled if it is due: after max_pages, or when a
+        check every check_interval seconds finds it over max_rss or not
+        responding. If the item fails because the browser stopped responding,
+        the browser is restarted and the item is tried again.
+
+        Args:
+            function (callable): The item, called as function(*args, **kwargs).
+
+        Returns:
+            The function's result.
+
+        Raises:
+            WebDriverException: If the item still fails after `max_restarts`.
+        """
+        self.__check_due()
+        for attempt in range(self.max_restarts + 1):
+            try:
+                result = function(*args, **kwargs)
+                self.count_pages()
+                return result
+            except WebDriverException as e:
+                if attempt == self.max_restarts:
+                    raise
+                self.restart(f"not responding ({type(e).__name__})")
+        return None
+
+    def count_pages(self, count=1):
+        """Counts pages opened in the browser."""
+        self.pages += count
+
+    def check(self):
+        """Restarts the browser if it has done max_pages, is over max_rss, or
+        does not respond.
+
+        Returns:
+            bool: True if the browser was restarted.
+        """
+        if self.pages >= self.max_pages:
+            self.restart(f"{self.pages} pages")
+            return True
+        rss = st.get_browser_rss()
+        if rss > self.max_rss:
+            self.restart(f"memory {rss / 1024 / 1024:.0f} MB")
+            return True
+        if not self.is_responsive():
+            self.restart("not responding")
+            return True
+        return False
+
+    def __check_due(self):
+        """Runs `check` once max_pages are done, or every check_interval seconds,
+        as it walks the browser's processes and waits for a script."""
+        if (
+            self.pages < self.max_pages
+            and time.time() - self.__last_check < self.check_interval
+        ):
+            return
+        self.__last_check = time.time()
+        self.check()
+
+    def is_responsive(self):
+        """Returns True if the browser answers a script in time."""
+        try:
+            return st.driver.execute_script("return 1;") == 1
+        except WebDriverException:
+            return False
+
+    def restart(self, reason):
+        """Quits (or kills) the browser, starts a new one and logs in again."""
+        self.restarts += 1
+        logger.warning(
+            "Restarting the browser (%s), restart %s.", reason, self.restarts
+        )
+        print(f"Restarting the browser: {reason}.")
+        resource_blocking = st.resource_blocking
+        self.__quit()
+        st.start_browser()
+        if st.resource_blocking != resource_blocking:
+            st.set_resource_blocking(resource_blocking)
+        if st.session_file:
+            st.open_saved_connection(st.current_logon, st.session_file)
+        else:
+            st.open_connection(st.current_logon)
+            st.load_browser_cookies()
+        self.__set_timeouts()
+        self.pages = 0
+        self.__last_check = time.time()
+
+    def __quit(self):
+        """Quits the browser. Kills its processes if it does not quit in time."""
+        pids = st.get_browser_pids()
+        quitter = threading.Thread(target=st.driver.quit, daemon=True)
+        quitter.start()
+        quitter.join(timeout=30)
+        for pid in pids if quitter.is_alive() else []:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                continue  # Already gone.
+        st.driver = None
+
+    def __set_timeouts(self):
+        """Makes a hung page load or script raise instead of waiting forever."""
+        if st.driver:
+            st.driver.set_page_load_timeout(self.page_timeout)
+            st.driver.set_script_timeout(self.page_timeout)
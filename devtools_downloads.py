@@ -0,0 +1,431 @@
+"""
+Browser downloads driven through the DevTools protocol.
+
+Chrome is told with `Browser.setDownloadBehavior` ("allowAndName") to save each
+download in one directory under its GUID, and to send download events. The
+events are read from the browser's performance log (the browser is started
+with `log_cdp_events`, see `st.start_browser`): `downloadWillBegin` gives the
+url and tab of a download, and `downloadProgress` tells when it completed or
+was canceled. So there is no polling of the disk for a file name, and two
+attachments with the same name can never overwrite each other while they
+download.
+
+The directory is on the same drive as the files, so a finished download is
+renamed to its final name, never copied.
+
+A `DownloadTabPool` keeps a fixed set of tabs open and reuses them: each tab
+opens its next url as soon as its previous download has completed, so no tab
+is opened or closed per file.
+
+Usage Example:
+    >>> tracker = DownloadTracker("sps_downloads/ibs/quotes/files/")
+    >>> tracker.enable()
+    >>> st.driver.get(url)
+    >>> download = tracker.wait_for_start(url, st.driver.current_window_handle)
+    >>> if download and tracker.wait_for_end(download):
+    ...     tracker.save(download, "sps_downloads/ibs/quotes/files/Q123/a.pdf")
+"""
+
+from dataclasses import dataclass
+import json
+import os
+import threading
+import time
+
+from selenium.common.exceptions import WebDriverException
+
+import modules.my_common_module as mymod
+import scrape_tools as st
+
+logger = st.logger
+
+
+@dataclass
+class BrowserDownload:
+    """A download reported by the browser.
+
+    Attributes:
+        guid (str): The download id, also its file name until it is saved.
+        url (str): The url downloaded.
+        frame_id (str): The frame that started it, the tab's window handle for
+            a download opened in a tab.
+        suggested_filename (str): The name the site gave the file.
+        state (str): "inProgress", "completed" or "canceled".
+        received_bytes (int): Bytes received so far.
+    """
+
+    guid: str
+    url: str
+    frame_id: str = ""
+    suggested_filename: str = ""
+    state: str = "inProgress"
+    received_bytes: int = 0
+
+
+class DownloadTracker:
+    """Follows the browser's downloads from the DevTools events.
+
+    Attributes:
+        directory (str): The full path Chrome saves the downloads in.
+        downloads (dict): GUID -> BrowserDownload, for all the downloads seen.
+    """
+
+    def __init__(self, directory):
+        self.directory = mymod.create_full_file_path(directory)
+        self.downloads = {}
+        self.__claimed = set()  # GUIDs already returned by wait_for_start.
+        self.__driver = None  # The browser the downloads were enabled in.
+        self.__lock = threading.Lock()
+
+    def enable(self):
+        """Makes the browser save downloads in `directory` under their GUID."""
+        os.makedirs(self.directory, exist_ok=True)
+        st.driver.execute_cdp_cmd(
+            "Browser.setDownloadBehavior",
+            {
+                "behavior": "allowAndName",
+                "downloadPath": self.directory,
+                "eventsEnabled": True,
+            },
+        )
+        self.__driver = st.driver
+        self.read_events()  # Drops the events logged before.
+
+    def is_enabled(self):
+        """Returns False if downloads are not enabled in the current browser, eg.
+        after it was restarted."""
+        return self.__driver is not None and self.__driver is st.driver
+
+    def read_events(self):
+        """Reads the new download events from the browser's performance log."""
+        with self.__lock:
+            for entry in st.driver.get_log("performance"):
+                message = json.loads(entry["message"])["message"]
+                method = message.get("method", "")
+                # Chrome sends both the Browser.* and the older Page.* events.
+                if method.endswith(".downloadWillBegin"):
+                    params = message["params"]
+                    self.downloads.setdefault(
+                        params["guid"],
+                        BrowserDownload(
+                            params["guid"],
+                            params.get("url", ""),
+                            params.get("frameId", ""),
+                            params.get("suggestedFilename", ""),
+                        ),
+                    )
+                elif method.endswith(".downloadProgress"):
+                    params = message["params"]
+                    download = self.downloads.get(params["guid"])
+                    if download:
+                        download.state = params["state"]
+                        download.received_bytes = params.get("receivedBytes", 0)
+
+    def wait_for_start(self, url, handle=None, timeout=30, is_stopped=None):
+        """Waits for the download of a url opened in a tab to begin.
+
+        The download is matched by the tab (its frame) or by the url, as the url
+        may have been redirected.
+
+        Args:
+            url (str): The url opened.
+            handle (str, optional): The window handle of the tab it was opened in.
+            timeout (float): Seconds to wait.
+            is_stopped (callable, optional): Returns True if the page will not
+                download, eg. it shows an error. Checked while waiting.
+
+        Returns:
+            BrowserDownload: The download, or None if it did not begin.
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.read_events()
+            download = self.claim(url, handle)
+            if download:
+                return download
+            if time.time() > deadline or (is_stopped and is_stopped()):
+                return None
+            time.sleep(0.2)
+
+    def claim(self, url, handle=None):
+        """Returns a download that began for the url or tab, from the events
+        read so far, and marks it as taken. None if there is none."""
+        with self.__lock:
+            for download in self.downloads.values():
+                if download.guid in self.__claimed:
+                    continue
+                if download.url == url or (handle and download.frame_id == handle):
+                    self.__claimed.add(download.guid)
+                    return download
+        return None
+
+    def discard_strays(self, urls, handles):
+        """Discards the finished downloads not taken, whose url and tab belong to
+        no job, eg. a download a page started by itself.
+
+        Args:
+            urls (set): The urls of the jobs not done yet.
+            handles (set): The window handles of the tabs in use.
+        """
+        with self.__lock:
+            strays = [
+                download
+                for download in self.downloads.values()
+                if download.guid not in self.__claimed
+                and download.state != "inProgress"
+                and download.url not in urls
+                and download.frame_id not in handles
+            ]
+        for download in strays:
+            logger.warning("Discarding a download no tab opened: %s", download.url)
+            self.discard(download)
+
+    def wait_for_end(self, download, timeout=600):
+        """Waits for a download to complete.
+
+        Returns:
+            bool: True if it completed, False if it was canceled or timed out.
+        """
+        deadline = time.time() + timeout
+        while download.state == "inProgress" and time.time() < deadline:
+            time.sleep(0.2)
+            self.read_events()
+        return download.state == "completed"
+
+    def save(self, download, destination):
+        """Renames a completed download to its destination (same drive).
+
+        Args:
+            download (BrowserDownload): The completed download.
+            destination (str): The destination, eg. 'sps_downloads/.../a.pdf'.
+
+        Returns:
+            str: The full destination path.
+        """
+        full_destination = mymod.create_full_file_path(destination)
+        mymod.check_directory(full_destination)
+        os.replace(os.path.join(self.directory, download.guid), full_destination)
+        self.forget(download)
+        return full_destination
+
+    def discard(self, download):
+        """Deletes the file of a download that failed."""
+        try:
+            os.remove(os.path.join(self.directory, download.guid))
+        except FileNotFoundError:
+            pass
+        self.forget(download)
+
+    def forget(self, download):
+        """Drops a finished download from `downloads`."""
+        with self.__lock:
+            self.downloads.pop(download.guid, None)
+            self.__claimed.discard(download.guid)
+
+
+@dataclass
+class DownloadJob:
+    """A url to download in the browser.
+
+    Attributes:
+        url (str): The url to open.
+        destination (str): The file to save it as.
+        item: Whatever the caller needs, eg. [key, filename].
+        attempts (int): The times the url has been opened.
+    """
+
+    url: str
+    destination: str
+    item: object = None
+    attempts: int = 0
+
+
+@dataclass
+class _TabSlot:
+    """A reused tab and the job it is downloading."""
+
+    handle: str
+    job: DownloadJob = None
+    download: BrowserDownload = None
+    started_at: float = 0
+    login_count: int = 0  # st.login_count when opened, for st.relogin.
+
+
+class DownloadTabPool:
+    """Downloads urls in a fixed set of reused browser tabs.
+
+    Attributes:
+        tracker (DownloadTracker): Follows the downloads.
+        supervisor (BrowserSupervisor): Restarts the browser if it stops
+            responding. The tabs are then opened again.
+        tab_count (int): The number of tabs.
+        start_timeout (float): Seconds a url may take to start downloading.
+        end_timeout (float): Seconds a download may take.
+        max_attempts (int): The most times a url is opened.
+    """
+
+    def __init__(
+        self,
+        tracker,
+        supervisor,
+        tab_count=4,
+        start_timeout=30,
+        end_timeout=600,
+        max_attempts=2,
+    ):
+        self.tracker = tracker
+        self.supervisor = supervisor
+        self.tab_count = tab_count
+        self.start_timeout = start_timeout
+        self.end_timeout = end_timeout
+        self.max_attempts = max_attempts
+        self.__queue = []
+        self.__slots = []
+        self.__main_handle = None
+
+    def run(self, jobs, on_done):
+        """Downloads the jobs, tab_count at a time.
+
+        Args:
+            jobs (list): The DownloadJob to download.
+            on_done (callable): Called as on_done(job, error) when a job is done,
+                error is None if it was saved, else why it failed, eg.
+                "access denied".
+        """
+        if not jobs:
+            return
+        self.__queue = list(reversed(jobs))
+        while self.__queue or any(slot.job for slot in self.__slots):
+            try:
+                if not self.__slots:
+                    self.__open_tabs()
+                self.__step(on_done)
+            except WebDriverException as e:
+                # The browser stopped responding: restart it and open the tabs again.
+                self.supervisor.restart(f"not responding ({type(e).__name__})")
+                for slot in self.__slots:
+                    if slot.job:
+                        self.__retry(slot.job, "lost in a browser restart", on_done)
+                self.__slots = []
+        self.__close_tabs()
+
+    def __open_tabs(self):
+        """Opens the tabs, and enables the downloads in a new browser."""
+        if not self.tracker.is_enabled():
+            self.tracker.enable()
+        self.__main_handle = st.driver.window_handles[0]
+        for _ in range(self.tab_count):
+            st.driver.switch_to.new_window("tab")
+            self.__slots.append(_TabSlot(st.driver.current_window_handle))
+
+    def __close_tabs(self):
+        """Closes the pool's tabs."""
+        for slot in self.__slots:
+            st.driver.switch_to.window(slot.handle)
+            st.driver.close()
+        self.__slots = []
+        if self.__main_handle:
+            st.driver.switch_to.window(self.__main_handle)
+
+    def __step(self, on_done):
+        """Starts jobs in the free tabs, then checks the tabs that are busy."""
+        for slot in self.__slots:
+            if slot.job is None and self.__queue:
+                self.__start(slot, self.__queue.pop())
+
+        self.tracker.read_events()
+        for slot in self.__slots:
+            if slot.job and not slot.download:
+                slot.download = self.tracker.claim(slot.job.url, slot.handle)
+        self.tracker.discard_strays(
+            {job.url for job in self.__queue}
+            | {slot.job.url for slot in self.__slots if slot.job},
+            {slot.handle for slot in self.__slots},
+        )
+
+        is_busy = False
+        for slot in self.__slots:
+            if slot.job is None:
+                continue
+            if slot.download:
+                is_busy |= self.__check_download(slot, on_done)
+            else:
+                is_busy |= self.__check_page(slot, on_done)
+        if is_busy:
+            time.sleep(0.2)
+
+    def __start(self, slot, job):
+        """Opens the job's url in the tab."""
+        job.attempts += 1
+        slot.job = job
+        slot.download = None
+        slot.started_at = time.time()
+        slot.login_count = st.login_count
+        st.driver.switch_to.window(slot.handle)
+        st.driver.get(job.url)
+        self.supervisor.count_pages()
+
+    def __check_download(self, slot, on_done):
+        """Saves the tab's download if complete, or fails it.
+
+        Returns:
+            bool: True if the download is still in progress.
+        """
+        download, job = slot.download, slot.job
+        if download.state == "inProgress":
+            if time.time() - slot.started_at < self.end_timeout:
+                return True
+            download.state = "timed out"
+        if download.state == "completed":
+            self.tracker.save(download, job.destination)
+            on_done(job, None)
+        else:
+            self.tracker.discard(download)
+            on_done(job, f"download {download.state}")
+        slot.job = None
+        return False
+
+    def __check_page(self, slot, on_done):
+        """Checks a tab whose download has not begun, for an error page.
+
+        A tab that showed a page is reset to a blank page, so a page shown
+        later can only be the current job's.
+
+        Returns:
+            bool: True if the tab is still waiting for its download.
+        """
+        job = slot.job
+        st.driver.switch_to.window(slot.handle)
+        if is_blank_page(st.driver.current_url):
+            if time.time() - slot.started_at < self.start_timeout:
+                return True
+            error = "download did not begin"
+        else:
+            page_source = st.driver.page_source
+            if st.is_login_page(page_source):
+                st.relogin(slot.login_count)  # The session expired.
+                error = "showed the login page"
+            elif "AccessDenied" in page_source:
+                error = "access denied"
+            else:
+                error = "page shown instead of a download"
+            st.driver.get("about:blank")
+        slot.job = None
+        if error == "access denied":
+            on_done(job, error)
+        else:
+            self.__retry(job, error, on_done)
+        return False
+
+    def __retry(self, job, reason, on_done):
+        """Queues the job again, or fails it after max_attempts."""
+        if job.attempts >= self.max_attempts:
+            on_done(job, reason)
+            return
+        logger.warning("Download %s, trying again: %s", reason, job.url)
+        self.__queue.append(job)
+
+
+def is_blank_page(url):
+    """Returns True for a new or blank tab."""
+    return url in ("about:blank", "chrome://new-tab-page/")
@@ -0,0 +1,297 @@
+"""
+Asyncio engine for downloading the attachments listed in 'dl_links.csv'.
+
+The browser download path (`file_download.download_link`) opens a tab for each
+file and waits for Chrome to save it. This engine instead downloads the files
+over the pooled HTTP transport with the browser's login cookies, running a
+configurable number of downloads at once. Files are written straight to
+`<download_directory>/<key>/`.
+
+Usage Example:
+    >>> st.load_browser_cookies()
+    >>> engine = DownloadEngine("sps_downloads/ibs/quotes/files/", 8)
+    >>> engine.run(links_dict)
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+import modules.my_common_module as mymod
+import modules.http_transport as transport
+
+
+class UrlRegistry:
+    """Run-wide registry so each distinct url is downloaded only once.
+
+    The first request for a url downloads it. Requests for the same url from
+    other workers wait for that download (single flight), then get a hardlink
+    or copy of the file at their own destination. Downloaded paths are saved
+    in a JSON file, so later runs for other tables can link to them too.
+
+    Example:
+        registry = UrlRegistry("sps_downloads/url_registry.json")
+        result = registry.fetch(url, destination, mymod.download_file)
+    """
+
+    def __init__(self, filename):
+        self.paths = mymod.JsonCache(filename)
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def fetch(self, url, destination, download, **kwargs):
+        """Downloads the url to the destination, or links it from an earlier download.
+
+        Args:
+            url (str): The file url.
+            destination (str): The path to save the file to.
+            download (callable): Called as download(url, destination, **kwargs)
+                to download the file. Should return a DownloadResult.
+
+        Returns:
+            DownloadResult: The download details. `linked_from` is set if the
+                file was linked from an earlier download.
+        """
+        full_destination = mymod.create_full_file_path(destination)
+        with self.__lock:
+            event = self.__in_flight.get(url)
+            is_owner = event is None
+            if is_owner:
+                event = self.__in_flight[url] = threading.Event()
+
+        if not is_owner:
+            event.wait()  # Another worker is downloading the url.
+            return self.__link(url, full_destination)
+
+        try:
+            existing_path = self.paths.get(url)
+            if (
+                existing_path
+                and existing_path != full_destination
+                and os.path.exists(existing_path)
+            ):
+                return self.__link(url, full_destination)
+            result = download(url, destination, **kwargs)
+            if result:
+                self.paths.set(url, full_destination)
+            return result
+        finally:
+            with self.__lock:
+                del self.__in_flight[url]
+            event.set()
+
+    def save(self):
+        """Writes the registry file."""
+        self.paths.save()
+
+    def __link(self, url, full_destination):
+        """Links the earlier download of the url to the destination."""
+        result = mymod.DownloadResult(url=url, destination=full_destination)
+        existing_path = self.paths.get(url)
+        if not existing_path or not os.path.exists(existing_path):
+            return result  # The download failed.
+        mymod.link_file(existing_path, full_destination)
+        result.is_downloaded = True
+        result.linked_from = existing_path
+        result.bytes_saved = os.path.getsize(full_destination)
+        print(f"Linked: {full_destination} -> {existing_path}")
+        return result
+
+
+class DownloadEngine:
+    """Downloads a dictionary of key -> [LinkDataClass] concurrently.
+
+    Attributes:
+        download_directory (str): The directory the per-key folders are created in.
+        max_concurrent (int): The number of downloads running at once.
+        queue_size (int): Max number of links waiting to be downloaded. The
+            producer blocks when the queue is full (backpressure).
+        segment_threshold (int): Files larger than this many bytes are
+            downloaded as parallel byte ranges. None to disable.
+        segments (int): Number of byte ranges for large files.
+        redirects (JsonCache): Optional mapping of link url -> resolved url, eg.
+            the image redirect cache, so redirects are not followed again. A
+            resolved url whose download fails is dropped from it.
+        resolve_redirect (callable): Optional. Called with a link url to resolve
+            it again when the download from its cached url failed, eg. an
+            expired signed url. The file is then downloaded once more.
+        validators (JsonCache): Optional store of ETag / Last-Modified /
+            Content-Length per url, so unchanged files are not downloaded again.
+        registry (UrlRegistry): Optional registry so a url listed under several
+            keys or tables is downloaded once, and linked for the others.
+        is_login_page (callable): Optional check of a downloaded page's html. If
+            it is the login page the session expired: it is not saved, `relogin`
+            is called and the file is downloaded again.
+        relogin (callable): Logs in again. Called once for all the workers that
+            find the session expired at the same time.
+        downloaded (list): [key, filename, url] rows that were downloaded.
+        unchanged (list): [key, filename, url] rows skipped as unchanged.
+        linked (list): [key, filename, url] rows linked from another download.
+        failed (list): [key, filename, url] rows that failed to download.
+        bytes_downloaded (int): Bytes downloaded.
+        bytes_saved (int): Bytes not downloaded because files were unchanged.
+    """
+
+    def __init__(
+        self,
+        download_directory,
+        max_concurrent=8,
+        queue_size=None,
+        segment_threshold=None,
+        segments=4,
+        redirects=None,
+        validators=None,
+        registry=None,
+        is_login_page=None,
+        relogin=None,
+        resolve_redirect=None,
+    ):
+        self.download_directory = download_directory
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size or max_concurrent * 2
+        self.segment_threshold = segment_threshold
+        self.segments = segments
+        self.redirects = redirects
+        self.validators = validators
+        self.registry = registry
+        self.is_login_page = is_login_page
+        self.relogin = relogin
+        self.resolve_redirect = resolve_redirect
+        self.downloaded = []
+        self.unchanged = []
+        self.linked = []
+        self.failed = []
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+        self.__total = 0
+        self.__done = 0
+        self.__lock = threading.Lock()
+        self.__login_lock = threading.Lock()
+        self.__login_count = 0
+
+    def run(self, links_dict):
+        """Downloads all the links and returns the list of failed rows."""
+        self.__total = sum(len(links) for links in links_dict.values())
+        print(
+            f"Downloading {self.__total} files from {len(links_dict)} keys "
+            f"with {self.max_concurrent} concurrent downloads."
+        )
+        start_time = time.time()
+        asyncio.run(self.__run(links_dict))
+        if self.validators is not None:
+            self.validators.save()
+        if self.registry is not None:
+            self.registry.save()
+        print(
+            f"Download engine finished in {time.time() - start_time:.1f} s: "
+            f"{len(self.downloaded)} downloaded ({self.bytes_downloaded} bytes), "
+            f"{len(self.unchanged)} unchanged, {len(self.linked)} linked "
+            f"({self.bytes_saved} bytes saved), {len(self.failed)} failed."
+        )
+        transport.print_stats()
+        return self.failed
+
+    async def __run(self, links_dict):
+        """Starts the producer and the download workers."""
+        # The default executor may have fewer threads than max_concurrent.
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_concurrent)
+        )
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        workers = [
+            asyncio.create_task(self.__worker(queue))
+            for _ in range(self.max_concurrent)
+        ]
+        for key, links in links_dict.items():
+            for link in links:
+                await queue.put((key, link))  # Waits while the queue is full.
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def __worker(self, queue):
+        """Takes links off the queue and downloads them in a thread."""
+        while True:
+            key, link = await queue.get()
+            try:
+                await asyncio.to_thread(self.download_link, key, link)
+            finally:
+                queue.task_done()
+
+    def download_link(self, key, link):
+        """Downloads one link into the folder for its key."""
+        filename = link.displayed_text
+        link_url = link.url.replace("\\", "/")
+        url = link_url
+        if self.redirects is not None:
+            url = self.redirects.get(link_url, link_url)
+        destination = self.download_directory + key + "/" + filename
+        result = self.__fetch(url, destination)
+        if not result and url != link_url:
+            # The cached url may have expired: drop it, and resolve it again.
+            self.redirects.delete(link_url)
+            if self.resolve_redirect is not None:
+                try:
+                    url = self.resolve_redirect(link_url)
+                except Exception as e:  # pylint: disable=W0718
+                    mymod.logger.error("Could not resolve %s: %s", link_url, e)
+                else:
+                    result = self.__fetch(url, destination)
+                    if result:
+                        self.redirects.set(link_url, url)
+        row = [key, filename, url]
+
+        with self.__lock:
+            self.__done += 1
+            if result and result.linked_from:
+                self.linked.append(row)
+                self.bytes_saved += result.bytes_saved
+                print(f"{self.__done}/{self.__total} Linked: {key}/{filename}")
+            elif result and result.is_unchanged:
+                self.unchanged.append(row)
+                self.bytes_saved += result.bytes_saved
+                print(f"{self.__done}/{self.__total} Unchanged: {key}/{filename}")
+            elif result:
+                self.downloaded.append(row)
+                self.bytes_downloaded += result.bytes_written
+                print(f"{self.__done}/{self.__total} Downloaded: {key}/{filename}")
+            else:
+                self.failed.append(row)
+                print(f"{self.__done}/{self.__total} File not downloaded: {url}")
+
+    def __fetch(self, url, destination):
+        """Downloads a url, through the registry if any. None if it raised."""
+        kwargs = {
+            "segment_threshold": self.segment_threshold,
+            "segments": self.segments,
+            "validators": self.validators,
+            "is_login_page": self.is_login_page,
+        }
+        try:
+            if self.registry is not None:
+                return self.registry.fetch(
+                    url, destination, self.download_file, **kwargs
+                )
+            return self.download_file(url, destination, **kwargs)
+        except Exception as e:  # pylint: disable=W0718
+            mymod.logger.error("Error downloading %s: %s", url, e)
+            return None
+
+    def download_file(self, url, destination, **kwargs):
+        """Downloads a file, logging in again if the login page came instead."""
+        for attempt in range(2):
+            seen_login_count = self.__login_count
+            result = mymod.download_file(url, destination, **kwargs)
+            if not result.is_login_page:
+                return result
+            if attempt == 1 or self.relogin is None:
+                break
+            with self.__login_lock:
+                if seen_login_count == self.__login_count:
+                    self.relogin()
+                    self.__login_count += 1
+        mymod.logger.error("Login page downloaded after logging in again: %s", url)
+        return result
@@ -1,17 +1,41 @@
 """Functions for downloading files."""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import string
 import unicodedata
 import re
+from urllib.parse import urljoin
+import requests
 from bs4 import BeautifulSoup
 import scrape_tools as st
 import modules.my_common_module as mymod
+import modules.http_transport as transport
+import modules.rate_limiter as rate_limiter
 from quality_check import QualityCheck
+from download_engine import DownloadEngine, UrlRegistry
+import browser_pool
+from browser_supervisor import BrowserSupervisor
+from tab_scheduler import TabCountTuner, TabJob, TabScheduler
+from devtools_downloads import DownloadJob, DownloadTabPool, DownloadTracker
 import products
 
 CONFIG = None
 LOGON_IDS = ["ibs", "dsi"]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tiff")
+logger = st.logger
+REDIRECTS = None  # Cache of image url -> redirected url. See get_redirect_cache().
+URL_REGISTRY = None  # Downloaded urls for all tables. See download_with_engine().
+SUPERVISOR = None  # Restarts the browser on long runs. See get_supervisor().
+DOWNLOAD_TRACKER = None  # See get_download_tracker().
+META_REFRESH_PATTERN = re.compile(
+    r"http-equiv=[\"']?refresh[^>]*url=([^\"'>]+)", re.IGNORECASE
+)
+SCRIPT_REDIRECT_PATTERN = re.compile(
+    r"\b(?:(?:window|document|top|self)\.location(?:\.href)?|location\.href)"
+    r"\s*=\s*[\"']([^\"']+)"
+    r"|\blocation\.(?:replace|assign)\(\s*[\"']([^\"']+)"
+)
 
 
 class DownloadConfig:
@@ -32,6 +56,42 @@ class DownloadConfig:
         check_files_tab_count (bool):
             Whether to check the number of files in the tab before waiting.
         is_debugging (bool): Whether debugging mode is enabled.
+        use_http (bool): Whether to fetch pages over HTTP with the browser's
+            login cookies, instead of opening browser tabs.
+        http_workers (int): Number of concurrent HTTP requests.
+        download_workers (int): Number of concurrent file downloads when
+            use_http is set.
+        use_http_login (bool): Whether to log in over HTTP without a browser.
+        browser_profile (str): The browser profile, a key of
+            `st.BROWSER_PROFILES`, eg. 'headless'.
+        browser_workers (int): Number of browser worker processes, each logged
+            in with its own browser. More than 1 uses `browser_pool`.
+        browser_max_pages (int): Pages after which the browser is restarted.
+        browser_max_rss_mb (int): Browser memory (MB) above which it is restarted.
+        browser_min_tabs (int): The fewest tabs loading at once. The number is
+            tuned between browser_min_tabs and browser_max_tabs while it runs.
+        browser_max_tabs (int): The most tabs loading at once.
+        use_saved_session (bool): Whether to reuse the subsidiary's saved login
+            session and persistent browser profile, and skip the login if the
+            session is still valid.
+        session_file (str): The subsidiary's saved session cookies.
+        browser_data_dir (str): The subsidiary's persistent Chrome user data dir.
+        use_page_tables (bool): Whether to read only the needed table from each
+            browser page, as JSON, instead of the whole page source.
+        keep_raw_html (bool): With use_page_tables, whether to also save the
+            whole page source of each files tab to raw_html_directory.
+        raw_html_directory (str): The directory of the whole files tab htmls.
+        use_devtools_downloads (bool): Whether to download the files in the
+            browser through the DevTools protocol, into devtools_directory,
+            and rename each one to its key folder when complete.
+        devtools_directory (str): The directory the browser downloads into. On
+            the same drive as file_download_directory.
+        download_tabs (int): Number of reused browser tabs downloading at once.
+            More than 1 uses `download_with_tabs`, which needs
+            use_devtools_downloads set before the browser is started.
+        browser_download_directory (str): The directory the browser saves its
+            downloads in, before they are moved to their key folder. Each
+            browser worker has its own.
     """
 
     def __init__(self, table_config_name):
@@ -44,7 +104,24 @@ class DownloadConfig:
         self.file_download_table_name = "tblFiles"
         self.is_debugging = False
         self.use_download_links_csv = False
+        self.use_http = False
+        self.http_workers = 16
+        self.download_workers = 8
+        self.use_http_login = False
+        self.browser_profile = "headed"
+        self.browser_workers = 1
+        self.browser_max_pages = 1000
+        self.browser_max_rss_mb = 2048
+        self.browser_min_tabs = 2
+        self.browser_max_tabs = 40
+        self.use_saved_session = False
+        self.use_page_tables = False
+        self.keep_raw_html = False
+        self.use_devtools_downloads = False
+        self.download_tabs = 1
+        self.browser_download_directory = "downloaded_files/"
         self.access_denied_links = []
+        self.secondary_ref = {}
         self.__set_directorys()
 
     def set_logon_id(self, logon_id):
@@ -63,7 +140,11 @@ class DownloadConfig:
         self.dir_prefix = f"sps_downloads/{subsidiary}/{self.table_config_name}/"
         self.top_level_page_file = self.dir_prefix + "top_level_pages.json"
         self.sub_pages_directory = self.dir_prefix + "files_tab_html/"
+        self.raw_html_directory = self.dir_prefix + "files_tab_html_raw/"
         self.file_download_directory = self.dir_prefix + "files/"
+        self.devtools_directory = self.dir_prefix + "downloading/"
+        self.session_file = f"sps_downloads/{subsidiary}/session_cookies.json"
+        self.browser_data_dir = f"sps_downloads/{subsidiary}/browser_data/"
 
     def __repr__(self):
         """String representation of the configuration for easier debugging."""
@@ -76,17 +157,18 @@ class DownloadConfig:
             f"table_url_form='{self.table_url_form}', "
             f"table_url_form_id_name='{self.table_url_form_id_name}', "
             f"file_download_table_name='{self.file_download_table_name}', "
-            f"is_debugging={self.is_debugging})"
+            f"is_debugging={self.is_debugging}, "
+            f"use_http={self.use_http})"
         )
 
 
 def delete_downloaded_files():
-    """Deletes all files in the "downloaded_files/" directory."""
+    """Deletes all files in the "downloaded_files/" directory, and in the
+    browser workers' folders in it."""
     directory = "downloaded_files/"
-    for file_name in os.listdir(directory):
-        file_path = os.path.join(directory, file_name)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            os.remove(os.path.join(root, file_name))
 
 
 def save_links_to_csv(links, filename):
@@ -99,12 +181,19 @@ def save_links_to_csv(links, filename):
     mymod.write_data_to_csv(result, filename, True, "w")
 
 
-def set_table_config(table_config_name):
-    """This must be called first."""
+def set_table_config(table_config_name, delete_downloads=True):
+    """This must be called first.
+
+    Args:
+        table_config_name (str): The table configuration name, eg. 'quotes'.
+        delete_downloads (bool): Whether to empty "downloaded_files/". False in
+            the browser workers, which share it with the other processes.
+    """
     global CONFIG  # pylint: disable=W0603
 
     CONFIG = DownloadConfig(table_config_name)
-    delete_downloaded_files()
+    if delete_downloads:
+        delete_downloaded_files()
 
 
 def set_debug_flag(debug_flag: bool = False):
@@ -124,7 +213,22 @@ def save_top_pages():
     Iterates through top level pages (w/ next button),
     then saves pages as JSON to TOP_LEVEL_PAGE_FILE.
     """
-    pages = st.get_all_pages(CONFIG.table.url_path, CONFIG.table.table_id)
+    if CONFIG.use_http and CONFIG.table.date_window_months:
+        pages = st.get_all_pages_by_date_window(
+            CONFIG.table.url_path,
+            CONFIG.table.table_id,
+            CONFIG.table.date_window_months,
+            CONFIG.http_workers,
+        )
+    elif CONFIG.use_http:
+        pages = st.get_all_pages_by_number(
+            CONFIG.table.url_path,
+            CONFIG.table.table_id,
+            CONFIG.table.page_param,
+            CONFIG.http_workers,
+        )
+    else:
+        pages = st.get_all_pages(CONFIG.table.url_path, CONFIG.table.table_id)
     mymod.save_json(pages, CONFIG.top_level_page_file)
 
 
@@ -144,11 +248,65 @@ def get_id_from_url(url):
         return None
 
 
-def start_browser():
-    """Open and logon using LOGON_ID = 0 (IBS) or 1 (DSI)."""
+def start_browser(is_pool_step=False):
+    """Open and logon using LOGON_ID = 0 (IBS) or 1 (DSI).
+
+    When CONFIG.use_http_login is set, logs in over HTTP instead, without
+    starting a browser. Only the HTTP steps (--http) can then be used.
+
+    When CONFIG.use_saved_session is set, the saved session is reused if the
+    site still accepts it (see `st.open_saved_connection`).
+
+    Args:
+        is_pool_step (bool): True for a step whose browser work all runs in the
+            `browser_pool` workers when CONFIG.browser_workers > 1 (and not
+            use_http). The workers log in, so the parent does not. Any other
+            step logs the parent in too.
+    """
+    logon = st.logons[CONFIG.get_logon_id()]
+    st.use_page_tables = CONFIG.use_page_tables
+    st.log_cdp_events = CONFIG.use_devtools_downloads
+    st.download_directory = CONFIG.browser_download_directory
+    if CONFIG.use_http_login:
+        if st.current_logon:
+            return
+        if CONFIG.use_saved_session:
+            st.open_saved_connection(logon, CONFIG.session_file, use_browser=False)
+        else:
+            st.open_http_connection(logon)
+        return
     if st.driver:
         return
-    st.open_connection(st.logons[CONFIG.get_logon_id()])
+    if is_pool_step and CONFIG.browser_workers > 1 and not CONFIG.use_http:
+        return  # Each worker logs in.
+    st.browser_profile = CONFIG.browser_profile
+    if CONFIG.use_saved_session:
+        st.browser_data_dir = CONFIG.browser_data_dir
+        st.open_saved_connection(logon, CONFIG.session_file)
+    else:
+        st.open_connection(logon)
+
+
+def get_supervisor():
+    """Gets the supervisor that restarts the browser when it is worn out or hangs."""
+    global SUPERVISOR  # pylint: disable=W0603
+    if SUPERVISOR is None:
+        SUPERVISOR = BrowserSupervisor(
+            max_pages=CONFIG.browser_max_pages,
+            max_rss=CONFIG.browser_max_rss_mb * 1024 * 1024,
+        )
+    return SUPERVISOR
+
+
+def get_download_tracker():
+    """Gets the tracker of the browser's DevTools downloads, enabling them in
+    the browser if needed (eg. after a restart)."""
+    global DOWNLOAD_TRACKER  # pylint: disable=W0603
+    if DOWNLOAD_TRACKER is None:
+        DOWNLOAD_TRACKER = DownloadTracker(CONFIG.devtools_directory)
+    if not DOWNLOAD_TRACKER.is_enabled():
+        DOWNLOAD_TRACKER.enable()
+    return DOWNLOAD_TRACKER
 
 
 def get_sub_page_links(column=None):
@@ -265,6 +423,7 @@ def clean_tabs():
             continue
         else:
             st.driver.close()
+    st.apply_resource_blocking()  # The blocking tab may have been closed.
 
 
 def remove_prefix(url):
@@ -287,90 +446,255 @@ def read_links_from_file(filename=""):
     return links
 
 
-def get_child_html_pages(get_links_from_file=False, start_num=0, end_num=None):
+def get_child_html_pages(
+    get_links_from_file=False, start_num=0, end_num=None, links=None
+):
     """Gets all the links from top level, and saves html of subpages.
 
+    When CONFIG.use_http is set, the pages are fetched over HTTP with the
+    browser's login cookies instead of opening a browser tab for each link.
+
     Args:
     get_links_from_file: If True, reads links from 'links.csv' instead of fetching them
       from the top level URL.
     start_num: The starting index of the links to process.
     end_num: The ending index of the links to process. If None, processes all links.
+    links: The links to process, for example from `lookup_records`. The
+      CONFIG.secondary_ref must already be set for them.
     """
     print("Getting child html pages....")
 
-    # Reading from file
-    if get_links_from_file:
-        links = read_links_from_file()
-    else:
-        links = get_sub_page_links()
+    if links is None:
+        # Reading from file
+        if get_links_from_file:
+            links = read_links_from_file()
+        else:
+            links = get_sub_page_links()
+
+        # Secondary links
+        if "{id_2}" in CONFIG.table.files_table_url_form:
+            __load_secondary_reference()
 
-    # Secondary links
-    if "{id_2}" in CONFIG.table.files_table_url_form:
-        __load_secondary_reference()
+    if CONFIG.use_http:
+        __get_child_html_pages_http(links, start_num, end_num)
+        return
+    if CONFIG.browser_workers > 1:
+        __get_child_html_pages_pool(links, start_num, end_num)
+        return
 
     clean_tabs()
-    counter = 0
     link_count = len(links)
-
-    # Break into chunks.
-    chunk_size = 40
-    link_chunks = list(iterate_in_chunks(links[start_num:end_num], chunk_size))
-    print(f"Doing links in chunks of {chunk_size}. Total chunks: {len(link_chunks)}.")
-    for link_chunk in link_chunks:
-        if CONFIG.is_debugging and counter > 20:
+    jobs = []
+    for abs_index, link in enumerate(links[start_num:end_num], start=start_num):
+        if CONFIG.is_debugging and abs_index - start_num > 20:
             break
+        files_url = get_files_url(link)
+        if files_url:
+            jobs.append(TabJob(files_url, [abs_index, link]))
+
+    def save_page(job, html_content):
+        abs_index, link = job.item
+        print(f"{abs_index} / {link_count}", end=" : ")
+        save_files_tab_html(link, job.url, html_content)
+
+    tuner = TabCountTuner(
+        CONFIG.browser_min_tabs,
+        CONFIG.browser_max_tabs,
+        max_browser_rss=CONFIG.browser_max_rss_mb * 1024 * 1024,
+    )
+    limiter = rate_limiter.get_limiter(st.current_logon.url)
+    scheduler = TabScheduler(tuner, limiter, get_supervisor())
+    failed = scheduler.run(jobs, lambda job: get_files_tab_html(job.item[1]), save_page)
+    print(f"Saved {scheduler.pages} of {len(jobs)} files tabs. {len(failed)} failed.")
 
-        st.driver.switch_to.window(st.driver.window_handles[0])
 
-        link_ids = {}
-        for link in link_chunk:
-            files_url = get_files_url(link)
-            abs_index = counter + start_num  # The index in the full list of links.
+def get_files_tab_html(link=None, files_url=None):
+    """Gets the html of the files tab open in the current tab.
 
-            if files_url:
-                link_ids[remove_prefix(files_url)] = [abs_index, link]
-                st.driver.execute_script(f"window.open('{files_url}');")
-            counter += 1
+    With CONFIG.use_page_tables only the files table is read (see
+    `st.get_page_html`), and with CONFIG.keep_raw_html the whole page source is
+    also saved to CONFIG.raw_html_directory.
 
-        # Iterate the tabs.
-        for handle in st.driver.window_handles:
-            st.driver.switch_to.window(handle)
-            url = st.driver.current_url
+    Args:
+        link (LinkDataClass, optional): The top level link, to name the raw html.
+        files_url (str, optional): The url the tab was opened with. If given,
+            logs in again if the session expired (see `st.get_page_source`).
+    """
+    table_ids = [CONFIG.file_download_table_name]
+    if files_url:
+        html_content = st.get_page_source(files_url, table_ids, True)
+    else:
+        html_content = st.get_page_html(table_ids, use_presentation_table=True)
+    if CONFIG.use_page_tables and CONFIG.keep_raw_html and link:
+        filename = sanitize_filename(get_clean_link_displayed_text(link))
+        mymod.save_page(
+            st.driver.page_source, CONFIG.raw_html_directory + filename + ".html"
+        )
+    return html_content
 
-            if is_blank_tab(url):
-                continue
 
-            abs_index = link_ids[remove_prefix(url)][0]
-            link = link_ids[remove_prefix(url)][1]
-            clean_link_text = get_clean_link_displayed_text(link)
+def save_files_tab_html(link, files_url, html_content):
+    """Saves the files tab html to SUB_PAGES_DIRECTORY if it lists any files.
+
+    Args:
+        link (LinkDataClass): The top level link the files tab belongs to.
+        files_url (str): The url of the files tab (for printing).
+        html_content (str): The html of the files tab.
+
+    Returns:
+        bool: True if the html was saved.
+    """
+    clean_link_text = get_clean_link_displayed_text(link)
+    print(f"Parent name={clean_link_text}", end=" : ")
+    print(f"Opening: {files_url}", end=" : ")
+
+    # Check if the table named "tblFiles" or the alternate version exists,
+    # and there are at least 1 row of file downloads.
+    table = st.get_table(html_content, CONFIG.file_download_table_name)
+    save_html = False
+    if not table:
+        save_html, num_rows = alternate_check_table_exists(html_content)
+    else:
+        num_rows = len(table.find_all("tr"))
+        if num_rows > 1:
+            save_html = True
+
+    if save_html:
+        filename = sanitize_filename(clean_link_text)
+        mymod.save_page(html_content, CONFIG.sub_pages_directory + filename + ".html")
+        print(f"Saved file: {filename} : Contains {num_rows} files(s).")
+    else:
+        print(" Empty files table.")
+    return save_html
+
+
+def __get_child_html_pages_http(links, start_num=0, end_num=None):
+    """Fetches the files tab pages concurrently over HTTP and saves the html.
+
+    Logs in once through the browser (see `start_browser`), then reuses its
+    cookies in a pooled HTTP session so no page has to be rendered in Chrome.
+    """
+    st.load_browser_cookies()
+    link_count = len(links)
+    counter = start_num
+
+    jobs = []
+    for link in links[start_num:end_num]:
+        if CONFIG.is_debugging and counter - start_num > 20:
+            break
+        files_url = get_files_url(link)
+        if files_url:
+            jobs.append([counter, link, files_url])
+        counter += 1
+
+    def fetch(job):
+        abs_index, link, files_url = job
+        response = st.fetch_page(files_url)  # Logs in again if the session expired.
+        return abs_index, link, files_url, response.text
+
+    print(f"Fetching {len(jobs)} files tabs with {CONFIG.http_workers} workers.")
+    with ThreadPoolExecutor(max_workers=CONFIG.http_workers) as executor:
+        futures = [executor.submit(fetch, job) for job in jobs]
+        for future in as_completed(futures):
+            try:
+                abs_index, link, files_url, html_content = future.result()
+            except (requests.RequestException, ConnectionError) as e:
+                logger.error("Error fetching files tab: %s", e)
+                continue
             print(f"{abs_index} / {link_count}", end=" : ")
-            print(f"Parent name={clean_link_text}", end=" : ")
-            print(f"Opening: {files_url}", end=" : ")
-            html_content = st.driver.page_source
-
-            # Check if the table named "tblFiles" or the alternate version exists,
-            # and there are at least 1 row of file downloads.
-            table = st.get_table(html_content, CONFIG.file_download_table_name)
-            save_html = False
-            if not table:
-                save_html, num_rows = alternate_check_table_exists(html_content)
-            else:
-                num_rows = len(table.find_all("tr"))
-                if num_rows > 1:
-                    save_html = True
-
-            if save_html:
-                filename = sanitize_filename(clean_link_text)
-                mymod.save_page(
-                    html_content, CONFIG.sub_pages_directory + filename + ".html"
-                )
-                print(f"Saved file: {filename} : Contains {num_rows} files(s).")
-            else:
-                print(" Empty files table.")
+            save_files_tab_html(link, files_url, html_content)
+    transport.print_stats()
 
-            st.driver.close()
 
-    st.driver.switch_to.window(st.driver.window_handles[0])
+def __get_child_html_pages_pool(links, start_num=0, end_num=None):
+    """Saves the files tab pages with a pool of CONFIG.browser_workers browsers.
+
+    Links that could not be done are written to 'pool_failed_links.csv'.
+    """
+    items = []
+    for abs_index, link in enumerate(links[start_num:end_num], start=start_num):
+        if CONFIG.is_debugging and abs_index - start_num > 20:
+            break
+        files_url = get_files_url(link)
+        if files_url:
+            items.append([abs_index, link.displayed_text, link.url, files_url])
+
+    results = browser_pool.run_pool(
+        "child_pages", items, CONFIG.browser_workers, __get_pool_settings()
+    )
+    saved = sum(1 for is_done, value in results.values() if is_done and value)
+    failed = [
+        items[index][1:3] + [value]
+        for index, (is_done, value) in sorted(results.items())
+        if not is_done
+    ]
+    print(f"Saved {saved} of {len(items)} files tabs. {len(failed)} failed.")
+    if failed:
+        mymod.write_data_to_csv(
+            failed, CONFIG.dir_prefix + "pool_failed_links.csv", has_header=False
+        )
+
+
+def __get_pool_settings():
+    """Gets the settings for the browser pool workers from CONFIG."""
+    return browser_pool.PoolSettings(
+        CONFIG.table_config_name,
+        CONFIG.get_logon_id(),
+        CONFIG.browser_profile,
+        CONFIG.is_debugging,
+        CONFIG.browser_max_pages,
+        CONFIG.browser_max_rss_mb,
+        CONFIG.use_saved_session,
+        CONFIG.use_page_tables,
+        CONFIG.keep_raw_html,
+        CONFIG.use_devtools_downloads,
+    )
+
+
+def lookup_records(search_values):
+    """Looks up specific transaction numbers and returns their links.
+
+    The searches run concurrently over HTTP, and results are cached in
+    'lookup_cache.json', so repeated lookups are instant. The links are saved
+    to 'lookup_links.csv', and their secondary links are added to
+    CONFIG.secondary_ref, ready for `get_child_html_pages(links=...)`.
+
+    Args:
+        search_values (list): Transaction numbers, eg. ["10149", "13237"].
+
+    Returns:
+        list: LinkDataClass links for the records found.
+    """
+    st.load_browser_cookies()
+    cache = mymod.JsonCache(CONFIG.dir_prefix + "lookup_cache.json")
+    print(f"Looking up {len(search_values)} records ({len(cache)} cached).")
+    links, secondary_links = st.search_records(
+        CONFIG.table, search_values, cache, CONFIG.http_workers
+    )
+
+    csv_data = []
+    for link, secondary_link in zip(links, secondary_links):
+        link_text = get_clean_link_displayed_text(link)
+        secondary_text = get_clean_link_displayed_text(secondary_link)
+        CONFIG.secondary_ref[link_text] = [secondary_text, secondary_link.url]
+        csv_data.append([link_text, link.url, secondary_text, secondary_link.url])
+    mymod.write_data_to_csv(
+        csv_data, CONFIG.dir_prefix + "lookup_links.csv", mode="w", has_header=False
+    )
+    print(f"Found {len(links)} links for {len(search_values)} records.")
+    return links
+
+
+def get_lookup_values(lookup):
+    """Gets the transaction numbers from a comma separated list, or a file of them.
+
+    >>> get_lookup_values("10149, 10284")
+        ['10149', '10284']
+    """
+    if os.path.isfile(lookup):
+        with open(lookup, "r", encoding="utf-8") as file:
+            lookup = file.read().replace("\n", ",")
+    return [value.strip() for value in lookup.split(",") if value.strip()]
 
 
 def download_link(key, link):
@@ -379,6 +703,9 @@ def download_link(key, link):
     filename = link.displayed_text
     new_url = link.url.replace("\\", "/")
     download_filename = CONFIG.file_download_directory + key + "/" + filename
+    if CONFIG.use_devtools_downloads:
+        __download_link_devtools(key, filename, new_url, download_filename)
+        return
 
     st.driver.execute_script("window.open('');")  # Opens a new tab
     file_downloaded = True
@@ -386,31 +713,91 @@ def download_link(key, link):
     # Images need specific download.
     # First, they redirect, so the url in the table is not the file.
     # Also, they do not automatically download like pdfs, etc. They are static.
-    if filename.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".tiff")):
-        new_url = get_redirect_url(new_url)
-        dl_filename = mymod.CODE_DIRECTORY + "downloaded_files/" + filename
-        st.mymod.download_file(new_url, dl_filename)
+    if is_image_file(filename):
+        dl_filename = (
+            mymod.CODE_DIRECTORY + CONFIG.browser_download_directory + filename
+        )
+        download_image(new_url, dl_filename)
     else:
         st.driver.get(new_url)  # Open the new URL in the new tab
+        st.get_page_source(new_url)  # Logs in again if the session expired.
 
     if __access_denied_error():
         file_downloaded = False
-        CONFIG.access_denied_links.append([key, filename, new_url])
-        mymod.write_data_to_csv(
-            [[key, filename, new_url]],
-            CONFIG.dir_prefix + "access_denied_files.csv",
-            has_header=False,
-        )
-
-        print("ACCESS DENIED ERROR:", end=" ")
+        __save_access_denied(key, filename, new_url)
     if file_downloaded:
-        mymod.move_file("downloaded_files/" + filename, download_filename)
+        mymod.move_file(
+            CONFIG.browser_download_directory + filename, download_filename
+        )
         print("Downloaded.")
     else:
         print(f"File not downloaded: {new_url}")
     __remove_non_blank_tabs()
 
 
+def __save_access_denied(key, filename, url):
+    """Records a link the site denied access to, in 'access_denied_files.csv'."""
+    CONFIG.access_denied_links.append([key, filename, url])
+    mymod.write_data_to_csv(
+        [[key, filename, url]],
+        CONFIG.dir_prefix + "access_denied_files.csv",
+        has_header=False,
+    )
+    print("ACCESS DENIED ERROR:", end=" ")
+
+
+def __is_error_page():
+    """Returns True if the current tab shows an error or the login page instead
+    of downloading."""
+    page_source = st.driver.page_source
+    return "AccessDenied" in page_source or st.is_login_page(page_source)
+
+
+def __download_link_devtools(key, filename, url, download_filename):
+    """Downloads a link in a new tab through DevTools, straight to its key folder.
+
+    The browser saves the file under a unique name in CONFIG.devtools_directory,
+    and it is renamed to download_filename when the browser reports it complete
+    (see `devtools_downloads`).
+    """
+    if is_image_file(filename):
+        # Images redirect to a static page rather than download: fetch the image
+        # with the login cookies straight to the destination.
+        download_image(url, download_filename)
+        print("Downloaded.")
+        return
+
+    tracker = get_download_tracker()
+    st.driver.switch_to.new_window("tab")
+    handle = st.driver.current_window_handle
+    try:
+        download = None
+        for attempt in range(2):
+            seen_login_count = st.login_count
+            st.driver.get(url)
+            download = tracker.wait_for_start(url, handle, is_stopped=__is_error_page)
+            if download or attempt or not st.is_login_page(st.driver.page_source):
+                break
+            st.relogin(seen_login_count)  # The session expired.
+            st.driver.switch_to.window(handle)
+
+        if download is None:
+            if "AccessDenied" in st.driver.page_source:
+                __save_access_denied(key, filename, url)
+            print(f"File not downloaded: {url}")
+            mymod.create_failed_file(mymod.create_full_file_path(download_filename))
+        elif tracker.wait_for_end(download):
+            tracker.save(download, download_filename)
+            print("Downloaded.")
+        else:
+            tracker.discard(download)
+            print(f"Download {download.state}: {url}")
+            mymod.create_failed_file(mymod.create_full_file_path(download_filename))
+    finally:
+        st.driver.close()
+        st.driver.switch_to.window(st.driver.window_handles[0])
+
+
 def get_all_download_links():
     """
     Gets all download links from the subpage html files. If the
@@ -464,9 +851,16 @@ def download_files_from_key(key, links, counter, qty_keys):
         qty_keys: The total number of keys.
     """
     print(f"Key {counter}/{qty_keys}: key_value='{key}'")
+    if CONFIG.use_http:
+        download_with_engine({key: links})
+        return
+    if st.BROWSER_PROFILES[st.browser_profile]["block_resources"]:
+        st.set_resource_blocking(False)  # Attachments may match the patterns.
+    supervisor = get_supervisor()
     for link in links:
         print(f"Downloading {key}/{link.displayed_text}", end=": ")
-        download_link(key, link)
+        supervisor.run(download_link, key, link)
+    get_redirect_cache().save()  # The image urls resolved for the key.
 
 
 def download_files_from_key_dictionary(links_dict, counter=0, qty_keys=None):
@@ -479,6 +873,15 @@ def download_files_from_key_dictionary(links_dict, counter=0, qty_keys=None):
           the links_dict.  Provide a value is this is a subset of larger dict.
 
     """
+    if CONFIG.use_http:
+        download_with_engine(links_dict)
+        return
+    if CONFIG.browser_workers > 1:
+        download_with_pool(links_dict)
+        return
+    if CONFIG.download_tabs > 1:
+        download_with_tabs(links_dict)
+        return
     if not qty_keys:
         qty_keys = len(links_dict.items())
     for key, links in links_dict.items():
@@ -486,6 +889,125 @@ def download_files_from_key_dictionary(links_dict, counter=0, qty_keys=None):
         download_files_from_key(key, links, counter, qty_keys)
 
 
+def download_with_pool(links_dict):
+    """Downloads all links in a dictionary with a pool of browser workers.
+
+    Each key is one item, so all of a key's files are downloaded by the same
+    worker. Keys that could not be done are written to 'pool_failed_keys.csv'.
+    """
+    items = [
+        [key, [[link.displayed_text, link.url] for link in links]]
+        for key, links in links_dict.items()
+    ]
+    delete_downloaded_files()  # Once for all the workers, before they start.
+    results = browser_pool.run_pool(
+        "downloads", items, CONFIG.browser_workers, __get_pool_settings()
+    )
+    failed = [
+        [items[index][0], value]
+        for index, (is_done, value) in sorted(results.items())
+        if not is_done
+    ]
+    print(f"Downloaded {len(items) - len(failed)} of {len(items)} keys.")
+    if failed:
+        mymod.write_data_to_csv(
+            failed, CONFIG.dir_prefix + "pool_failed_keys.csv", has_header=False
+        )
+
+
+def download_with_tabs(links_dict):
+    """Downloads all links in a dictionary in CONFIG.download_tabs browser tabs.
+
+    The tabs are opened once and reused: each opens its next link as soon as
+    its download has completed. The files are downloaded through DevTools
+    straight to 'files/<key>/' (see `devtools_downloads`), and image links are
+    fetched over HTTP. Failed downloads are appended to 'failed_downloads.csv'.
+    Resource blocking is turned off while downloading, then set back.
+    """
+    was_blocking = st.resource_blocking
+    if was_blocking:
+        st.set_resource_blocking(False)  # Attachments may match the patterns.
+    jobs = []
+    for key, links in links_dict.items():
+        for link in links:
+            filename = link.displayed_text
+            url = link.url.replace("\\", "/")
+            destination = CONFIG.file_download_directory + key + "/" + filename
+            if is_image_file(filename):
+                print(f"Downloading {key}/{filename}", end=": ")
+                download_image(url, destination)
+            else:
+                jobs.append(DownloadJob(url, destination, [key, filename]))
+
+    done = []
+    failed = []
+
+    def on_done(job, error):
+        key, filename = job.item
+        done.append(job)
+        if error is None:
+            print(f"{len(done)}/{len(jobs)} Downloaded: {key}/{filename}")
+            return
+        if error == "access denied":
+            __save_access_denied(key, filename, job.url)
+        print(f"{len(done)}/{len(jobs)} File not downloaded ({error}): {job.url}")
+        mymod.create_failed_file(mymod.create_full_file_path(job.destination))
+        failed.append([key, filename, job.url])
+
+    print(f"Downloading {len(jobs)} files in {CONFIG.download_tabs} tabs.")
+    pool = DownloadTabPool(
+        get_download_tracker(), get_supervisor(), CONFIG.download_tabs
+    )
+    try:
+        pool.run(jobs, on_done)
+    finally:
+        if was_blocking:
+            st.set_resource_blocking(True)
+    get_redirect_cache().save()
+    if failed:
+        mymod.write_data_to_csv(
+            failed, CONFIG.dir_prefix + "failed_downloads.csv", has_header=False
+        )
+    return failed
+
+
+def download_with_engine(links_dict):
+    """Downloads all links in a dictionary with the asyncio download engine.
+
+    Files go straight to 'files/<key>/' over HTTP, using the browser's login
+    cookies, with CONFIG.download_workers downloads running at once. Files
+    already downloaded are skipped if unchanged on the server, using the
+    validators saved in 'download_validators.json'. A url already downloaded
+    (under another key, or for another table) is linked instead of downloaded,
+    using 'sps_downloads/url_registry.json'. If the session expires, the login
+    page is not kept as the file: the engine logs in again and retries it.
+    Failed downloads are appended to 'failed_downloads.csv'.
+    """
+    global URL_REGISTRY  # pylint: disable=W0603
+    if URL_REGISTRY is None:
+        URL_REGISTRY = UrlRegistry("sps_downloads/url_registry.json")
+    st.load_browser_cookies()
+    engine = DownloadEngine(
+        CONFIG.file_download_directory,
+        CONFIG.download_workers,
+        redirects=get_redirect_cache(),
+        validators=mymod.JsonCache(CONFIG.dir_prefix + "download_validators.json"),
+        registry=URL_REGISTRY,
+        segment_threshold=CONFIG.table.download_segment_threshold,
+        segments=CONFIG.table.download_segments,
+        is_login_page=st.is_login_page,
+        relogin=st.relogin,
+        resolve_redirect=resolve_redirect,
+    )
+    failed = engine.run(links_dict)
+    get_redirect_cache().save()  # Redirects that failed were dropped.
+    if failed:
+        mymod.write_data_to_csv(
+            failed, CONFIG.dir_prefix + "failed_downloads.csv", has_header=False
+        )
+    return failed
+
+
 def process_file_downloads(
     file_dl_key="", start_num=0, end_num=None, all_links=None, skip_prompt=False
 ):
@@ -501,6 +1023,7 @@ def process_file_downloads(
             except:  # pylint: disable=W0702
                 print(f"ERROR: no file_dl_key : {file_dl_key} found.")
                 return
+            resolve_image_redirects({file_dl_key: links})
             download_files_from_key(file_dl_key, links, 1, 1)
             if skip_prompt:
                 file_dl_key = ""
@@ -508,6 +1031,8 @@ def process_file_downloads(
                 file_dl_key = input("\n\n\nNext file download key (Enter to quit):")
     else:
         target_links = mymod.extract_subset_from_dict(all_links, start_num, end_num)
+        if CONFIG.browser_workers <= 1:  # Else the workers resolve them.
+            resolve_image_redirects(target_links)
         download_files_from_key_dictionary(target_links, start_num, len(all_links))
 
 
@@ -519,6 +1044,135 @@ def __remove_non_blank_tabs():
             st.driver.close()
 
 
+def is_image_file(filename):
+    """Images redirect to the file, and are not downloaded by the browser."""
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def get_redirect_cache():
+    """Gets the redirect cache, stored in 'redirect_cache.json'."""
+    global REDIRECTS  # pylint: disable=W0603
+    filename = CONFIG.dir_prefix + "redirect_cache.json"
+    if REDIRECTS is None or REDIRECTS.filename != filename:
+        REDIRECTS = mymod.JsonCache(filename)
+    return REDIRECTS
+
+
+def resolve_image_redirects(links_dict):
+    """Resolves the redirects of all image links over HTTP, into the redirect cache.
+
+    Only urls not already in the cache are requested, several at once.
+    """
+    cache = get_redirect_cache()
+    urls = {
+        link.url.replace("\\", "/")
+        for links in links_dict.values()
+        for link in links
+        if is_image_file(link.displayed_text)
+    }
+    urls = [url for url in urls if url not in cache]
+    if not urls:
+        return
+    st.load_browser_cookies()
+    print(f"Resolving {len(urls)} image redirects ({len(cache)} cached)...")
+    with ThreadPoolExecutor(max_workers=CONFIG.http_workers) as executor:
+        futures = {executor.submit(resolve_redirect, url): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                cache.set(futures[future], future.result())
+            except requests.RequestException as e:
+                logger.error("Could not resolve redirect %s: %s", futures[future], e)
+    cache.save()
+
+
+def resolve_redirect(url, max_redirects=10):
+    """Follows the redirects of a url over HTTP without downloading the file.
+
+    HTTP redirects are followed with HEAD requests (GET if HEAD is not allowed).
+    An html page that redirects with a meta refresh or script is also followed.
+
+    Returns:
+        str: The final url.
+
+    Raises:
+        requests.RequestException: If the url leads to the login page, eg. the
+            session expired, or to an error status, so it is not cached as the
+            image url.
+    """
+    for _ in range(max_redirects):
+        response = transport.head(url, allow_redirects=False, timeout=15)
+        if response.status_code in (403, 405, 501):  # HEAD may not be allowed.
+            response = transport.get(
+                url, allow_redirects=False, stream=True, timeout=15
+            )
+            response.close()
+        if response.is_redirect:
+            url = urljoin(url, response.headers["Location"])
+            continue
+        response.raise_for_status()  # Eg. a 404, or a 503 after the retries.
+        if "text/html" in response.headers.get("Content-Type", ""):
+            html_content = transport.get(url, timeout=15).text
+            if st.is_login_page(html_content):
+                raise requests.RequestException(f"Redirected to the login page: {url}")
+            page_url = get_page_redirect_url(html_content)
+            if page_url:
+                url = urljoin(url, page_url)
+                continue
+        return url
+    return url
+
+
+def get_page_redirect_url(html_content):
+    """Gets the url from a meta refresh, or a script that sets window.location or
+    location.href, or None."""
+    match = META_REFRESH_PATTERN.search(html_content)
+    match = match or SCRIPT_REDIRECT_PATTERN.search(html_content)
+    if match:
+        return next(group for group in match.groups() if group)
+    return None
+
+
+def get_image_url(url):
+    """Gets the redirected url of an image, from the cache or over HTTP.
+
+    Falls back to opening the url in the browser (`get_redirect_url`). The cache
+    is saved by the caller once its batch is done, not for each image.
+    """
+    fixed_url = url.replace("\\", "/")
+    cache = get_redirect_cache()
+    if fixed_url in cache:
+        return cache.get(fixed_url)
+    try:
+        new_url = resolve_redirect(fixed_url)
+    except requests.RequestException as e:
+        logger.error("Could not resolve redirect over HTTP %s: %s", fixed_url, e)
+        return get_redirect_url(fixed_url)
+    cache.set(fixed_url, new_url)
+    return new_url
+
+
+def download_image(url, destination):
+    """Downloads an image from its redirected url (see `get_image_url`).
+
+    If the download fails, the url is dropped from the redirect cache, so it is
+    resolved again. A cached url may have expired, eg. a signed storage url, so
+    it is then resolved and downloaded once more at once.
+
+    Returns:
+        DownloadResult: The download details.
+    """
+    fixed_url = url.replace("\\", "/")
+    is_cached = fixed_url in get_redirect_cache()
+    for _ in range(2 if is_cached else 1):
+        result = mymod.download_file(
+            get_image_url(fixed_url), destination, is_login_page=st.is_login_page
+        )
+        if result or result.is_login_page:
+            break
+        get_redirect_cache().delete(fixed_url)
+    return result
+
+
 def get_redirect_url(url):
     """Waits for url to be redirected, returns the new url."""
     fixed_url = url.replace("\\", "/")
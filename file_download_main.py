@@ -10,19 +10,20 @@ def do_choice(choice, args):
         fd.start_browser()
         fd.save_top_pages()
     elif choice == 2:
-        fd.start_browser()
+        fd.start_browser(is_pool_step=True)
         fd.get_child_html_pages(start_num=args.start_num, end_num=args.end_num)
     elif choice == 3:
-        fd.start_browser()
+        fd.start_browser(is_pool_step=True)
         fd.get_child_html_pages(True, start_num=args.start_num, end_num=args.end_num)
     elif choice == 4:
-        fd.start_browser()
+        # A single key is downloaded in this process, not by the pool.
+        fd.start_browser(is_pool_step=not args.file_dl_key)
         fd.process_file_downloads(
             args.file_dl_key, start_num=args.start_num, end_num=args.end_num
         )
     elif choice == 5:
         fd.CONFIG.use_download_links_csv = True
-        fd.start_browser()
+        fd.start_browser(is_pool_step=not args.file_dl_key)
         fd.process_file_downloads(
             args.file_dl_key, start_num=args.start_num, end_num=args.end_num
         )
@@ -55,8 +56,13 @@ def do_choice(choice, args):
         fd.quality_check_products()
     elif choice == 17:
         fd.download_missing_images()
+    elif choice == 18:
+        lookup = args.lookup or input("Transaction numbers (comma separated) or file: ")
+        fd.start_browser()
+        links = fd.lookup_records(fd.get_lookup_values(lookup))
+        fd.get_child_html_pages(links=links)
     else:
-        print("Invalid choice. Please enter a number between 1 and 15.")
+        print("Invalid choice. Please enter a number between 1 and 18.")
     return
 
 
@@ -84,6 +90,8 @@ def get_choice():
     print("  15. Get product images. (read from link file)")
     print("  16. Quality check product images.")
     print("  17. Download missing images.")
+    print("\n  ---- Targeted records")
+    print("  18. Look up transaction numbers and save their child pages. (--lookup)")
 
     return int(input("Enter your choice (1-11): "))
 
@@ -98,6 +106,24 @@ def do_session(args):
     fd.set_table_config(args.table_config)
     fd.set_debug_flag(args.debug)
     fd.CONFIG.set_logon_id(args.logon_id)
+    fd.CONFIG.use_http = args.http
+    fd.CONFIG.download_workers = args.download_workers
+    fd.CONFIG.use_http_login = args.http_login
+    fd.CONFIG.browser_profile = args.browser_profile
+    fd.CONFIG.browser_workers = args.browser_workers
+    fd.CONFIG.browser_max_pages = args.browser_max_pages
+    fd.CONFIG.browser_max_rss_mb = args.browser_max_rss_mb
+    fd.CONFIG.browser_min_tabs = args.browser_min_tabs
+    fd.CONFIG.browser_max_tabs = args.browser_max_tabs
+    fd.CONFIG.use_saved_session = args.saved_session
+    fd.CONFIG.use_page_tables = args.page_tables
+    fd.CONFIG.keep_raw_html = args.keep_raw_html
+    fd.CONFIG.use_devtools_downloads = args.devtools_downloads
+    fd.CONFIG.download_tabs = args.download_tabs
+    if args.download_tabs > 1:
+        fd.CONFIG.use_devtools_downloads = True
+    if args.http_login:
+        fd.CONFIG.use_http = True
 
     if args.option is not None:
         do_choice(args.option, args)
@@ -118,7 +144,7 @@ def main():
     parser.add_argument(
         "--option",
         type=int,
-        choices=list(range(1, 18)),
+        choices=list(range(1, 19)),
         help="Specify an option (1, 2, or 3).",
     )
     parser.add_argument(
@@ -128,13 +154,103 @@ def main():
         help="Specify the logon ID. (0 = IBS, 1 = DSI",
     )
     parser.add_argument("--debug", action="store_true", help="Enable debug mode.")
+    parser.add_argument(
+        "--http",
+        action="store_true",
+        help="Fetch files tab pages and downloads over HTTP using the browser login.",
+    )
+    parser.add_argument(
+        "--http_login",
+        action="store_true",
+        help="Log in over HTTP without a browser (implies --http).",
+    )
+    parser.add_argument(
+        "--browser_profile",
+        type=str,
+        default="headed",
+        choices=["headed", "headless", "xvfb"],
+        help="Browser profile. headless and xvfb block css, fonts and images.",
+    )
+    parser.add_argument(
+        "--browser_workers",
+        type=int,
+        default=1,
+        help="Number of browser worker processes, each logged in separately.",
+    )
+    parser.add_argument(
+        "--saved_session",
+        action="store_true",
+        help="Reuse the saved login session and browser profile if still valid.",
+    )
+    parser.add_argument(
+        "--page_tables",
+        action="store_true",
+        help="Read only the needed table from each browser page, as JSON.",
+    )
+    parser.add_argument(
+        "--keep_raw_html",
+        action="store_true",
+        help="With --page_tables, also save the whole files tab pages.",
+    )
+    parser.add_argument(
+        "--devtools_downloads",
+        action="store_true",
+        help="Download in the browser through DevTools, straight to each key folder.",
+    )
+    parser.add_argument(
+        "--browser_max_pages",
+        type=int,
+        default=1000,
+        help="Restart the browser after this many pages.",
+    )
+    parser.add_argument(
+        "--browser_max_rss_mb",
+        type=int,
+        default=2048,
+        help="Restart the browser when its memory is over this many MB.",
+    )
+    parser.add_argument(
+        "--browser_min_tabs",
+        type=int,
+        default=2,
+        help="The fewest tabs loading at once, the number is tuned while running.",
+    )
+    parser.add_argument(
+        "--browser_max_tabs",
+        type=int,
+        default=40,
+        help="The most tabs loading at once.",
+    )
+    parser.add_argument(
+        "--download_workers",
+        type=int,
+        default=8,
+        help="Number of concurrent downloads when using --http.",
+    )
+    parser.add_argument(
+        "--download_tabs",
+        type=int,
+        default=1,
+        help="Number of reused browser tabs downloading at once (implies "
+        "--devtools_downloads if more than 1).",
+    )
     parser.add_argument(
         "--table_config", type=str, default="", help="Specify the table configuration."
     )
     parser.add_argument(
         "--file_dl_key", type=str, default="", help="Specify the key to download."
     )
+    parser.add_argument(
+        "--lookup",
+        type=str,
+        default="",
+        help="Transaction numbers to look up (comma separated, or a file of them).",
+    )
     args = parser.parse_args()
+    if not 1 <= args.browser_min_tabs <= args.browser_max_tabs:
+        parser.error(
+            "--browser_min_tabs must be at least 1 and at most --browser_max_tabs."
+        )
     do_session(args)
 
 
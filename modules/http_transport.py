@@ -0,0 +1,239 @@
+"""Shared pooled HTTP transport for all the non-browser fetches.
+
+Each thread gets its own `requests.Session` with a keep-alive connection pool,
+so threads never share a session but do share the default headers and the
+login cookie jar. A session's connections are closed when its thread ends, eg.
+when an executor shuts down, so short-lived threads do not leave sockets open.
+The pools count new connections and requests, so the connection reuse can be
+seen with `get_stats()`. Every request also takes a slot from the per-host
+adaptive limiter (see `modules.rate_limiter`), so the number of requests in
+flight to a host follows what it can sustain, whatever the number of threads.
+`request()`, `get()`, `post()` and `head()` send on the thread's session with
+the shared retry policy (see `modules.retry_policy`); POST requests are not
+retried unless asked for.
+
+Example:
+    import modules.http_transport as transport
+
+    transport.set_cookies(browser_cookies)
+    response = transport.get(url, timeout=8)
+    print(transport.get_stats())
+"""
+
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import modules.rate_limiter as rate_limiter
+import modules.retry_policy as retry_policy
+
+# Methods that can be sent again safely when a try fails.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Each thread has its own session, so a thread only needs a few connections per
+# host: the site, the file storage host the attachments redirect to, and spares.
+POOL_CONNECTIONS = 4  # Number of hosts to keep pools for, per thread.
+POOL_MAXSIZE = 4  # Connections kept per host, per thread.
+
+default_headers = {"Connection": "keep-alive"}
+cookie_jar = requests.cookies.RequestsCookieJar()
+
+_local = threading.local()
+_sessions = weakref.WeakSet()  # The live sessions, for set_default_headers().
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "new_connections": 0, "sessions": 0}
+
+
+def _count(name):
+    """Increments a transport counter."""
+    with _stats_lock:
+        _stats[name] += 1
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """HTTP connection pool that counts requests and new connections."""
+
+    def _new_conn(self):
+        _count("new_connections")
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):  # pylint: disable=W0221
+        _count("requests")
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPS connection pool that counts requests and new connections."""
+
+    def _new_conn(self):
+        _count("new_connections")
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):  # pylint: disable=W0221
+        _count("requests")
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """Adapter whose pools count connections for `get_stats()`, and whose
+    requests are limited per host by `rate_limiter`."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, *args, **kwargs):  # pylint: disable=W0221
+        # The slot is held until the response headers arrive. A streamed body
+        # is read after the slot is released.
+        limiter = rate_limiter.get_limiter(request.url)
+        limiter.acquire()
+        start_time = time.time()
+        try:
+            response = super().send(request, *args, **kwargs)
+        except Exception:
+            limiter.release(time.time() - start_time, is_error=True)
+            raise
+        is_error = response.status_code == 429 or response.status_code >= 500
+        limiter.release(time.time() - start_time, is_error=is_error)
+        return response
+
+
+def new_session():
+    """Creates a pooled session using the shared headers and cookie jar."""
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(
+        pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(default_headers)
+    session.cookies = cookie_jar
+    _count("sessions")
+    with _stats_lock:
+        _sessions.add(session)
+    # Closes the connection pools when the session is dropped with its thread.
+    weakref.finalize(session, _close_adapters, list(session.adapters.values()))
+    return session
+
+
+def _close_adapters(adapters):
+    """Closes the connection pools of a session that is gone."""
+    for adapter in adapters:
+        adapter.close()
+
+
+def get_session():
+    """Returns the pooled session for the current thread, creating it if needed.
+
+    The session is only kept by the thread, so it is dropped and closed when
+    the thread ends.
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = new_session()
+        _local.session = session
+    return session
+
+
+def request(method, url, is_retried=None, **kwargs):
+    """Sends a request on the thread's session, retrying temporary failures.
+
+    Connection errors, timeouts and 408 / 429 / 5xx responses are retried with
+    backoff by `retry_policy.HTTP_POLICY`, and the host is paused by its
+    circuit breaker after repeated failures.
+
+    Args:
+        method (str): The HTTP method, eg. 'GET'.
+        url (str): The url.
+        is_retried (bool, optional): Whether failures are retried. By default
+            only for the IDEMPOTENT_METHODS, so a postback or a login is never
+            sent twice.
+        **kwargs: Passed to `requests.Session.request`, eg. timeout or data.
+
+    Returns:
+        requests.Response: The response. The last one if all the tries failed.
+    """
+    if is_retried is None:
+        is_retried = method.upper() in IDEMPOTENT_METHODS
+    policy = (
+        retry_policy.HTTP_POLICY if is_retried else retry_policy.HTTP_NO_RETRY_POLICY
+    )
+    return policy.call(
+        get_session().request,
+        method,
+        url,
+        host=rate_limiter.get_host(url),
+        should_retry=retry_policy.is_retryable_response,
+        **kwargs,
+    )
+
+
+def get(url, **kwargs):
+    """Sends a GET request with retries. See `request()`."""
+    return request("GET", url, **kwargs)
+
+
+def post(url, is_retried=False, **kwargs):
+    """Sends a POST request, without retries unless is_retried. See `request()`."""
+    return request("POST", url, is_retried=is_retried, **kwargs)
+
+
+def head(url, **kwargs):
+    """Sends a HEAD request with retries. See `request()`."""
+    return request("HEAD", url, **kwargs)
+
+
+def set_default_headers(headers):
+    """Sets headers sent by every session, eg. the browser's User-Agent."""
+    default_headers.update(headers)
+    with _stats_lock:
+        for session in list(_sessions):
+            session.headers.update(headers)
+
+
+def set_cookies(cookies):
+    """Loads cookies into the shared jar.
+
+    Args:
+        cookies (list): Cookie dicts as returned by selenium's `get_cookies()`.
+    """
+    for cookie in cookies:
+        cookie_jar.set(
+            cookie["name"],
+            cookie["value"],
+            domain=cookie.get("domain"),
+            path=cookie.get("path", "/"),
+        )
+
+
+def get_stats():
+    """Returns the transport counters.
+
+    Returns:
+        dict: 'requests', 'new_connections', 'sessions' (created),
+            'live_sessions' and 'reused_connections' (requests that did not
+            need a new connection).
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+        stats["live_sessions"] = len(_sessions)
+    stats["reused_connections"] = stats["requests"] - stats["new_connections"]
+    return stats
+
+
+def print_stats():
+    """Prints the connection reuse counters."""
+    stats = get_stats()
+    print(
+        f"HTTP transport: {stats['requests']} requests, "
+        f"{stats['new_connections']} new connections, "
+        f"{stats['reused_connections']} reused, {stats['sessions']} sessions "
+        f"({stats['live_sessions']} open)."
+    )
+    rate_limiter.print_stats()
@@ -5,13 +5,20 @@ import json
 import logging
 import os
 import csv
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 import inspect
 import re
+import threading
 import requests
 import numpy as np
 import time
 
+import modules.http_transport as transport
+import modules.rate_limiter as rate_limiter
+import modules.retry_policy as retry_policy
+
 CODE_DIRECTORY = "/home/twv123/my_code_projects/python/webscrape/"
 ROOT_DIRECTORY = "/mnt/chromeos/removable/easystore/linux_files/"
 
@@ -127,27 +134,423 @@ def get_filename(filepath):
     return os.path.splitext(os.path.basename(filepath))[0]
 
 
-def download_file(url, destination):
+@dataclass
+class DownloadResult:
+    """Result of a file download. Evaluates as True if the file was downloaded.
+
+    Attributes:
+        url (str): The URL downloaded from.
+        destination (str): The full path of the downloaded file.
+        is_downloaded (bool): True if the file was completely downloaded.
+        status_code (int): The HTTP status code, or None if no response.
+        bytes_written (int): Bytes written by this call (excludes resumed bytes).
+        duration (float): Seconds taken.
+        is_resumed (bool): True if an earlier partial download was continued.
+        is_unchanged (bool): True if the existing file was kept because the
+            server copy has not changed.
+        bytes_saved (int): Bytes not downloaded because the file was unchanged.
+        etag (str): The ETag response header, if any.
+        last_modified (str): The Last-Modified response header, if any.
+        linked_from (str): The already downloaded file this one was linked or
+            copied from, instead of downloading it again.
+        is_login_page (bool): True if the site sent its login page instead of
+            the file, eg. the session expired. It is not kept.
+    """
+
+    url: str
+    destination: str
+    is_downloaded: bool = False
+    status_code: int = None
+    bytes_written: int = 0
+    duration: float = 0.0
+    is_resumed: bool = False
+    is_unchanged: bool = False
+    bytes_saved: int = 0
+    etag: str = None
+    last_modified: str = None
+    linked_from: str = None
+    is_login_page: bool = False
+
+    def __bool__(self):
+        return self.is_downloaded
+
+
+def download_file(
+    url,
+    destination,
+    session=None,
+    chunk_size=256 * 1024,
+    timeout=8,
+    segment_threshold=None,
+    segments=4,
+    validators=None,
+    is_login_page=None,
+):
     """Downloads a file from the specified URL and saves it to the given destination path.
 
+    The response is streamed in chunks to '<destination>.part', which is renamed
+    to the destination when complete, so a partly written file never has the
+    final name. If a '.part' file is left from an interrupted download, the
+    download resumes from its end with an HTTP Range request.
+
+    Files larger than `segment_threshold` bytes are downloaded as parallel byte
+    ranges when the server accepts ranges (see `download_file_segmented`). This
+    is decided from the headers of the download's own GET response.
+
+    Interrupted downloads and temporary errors (eg. 503) are retried by
+    `retry_policy.DOWNLOAD_POLICY`, continuing from the partial file.
+
+    If `validators` is given and the destination already exists, the file is
+    only downloaded again if it changed on the server (see `is_file_unchanged`).
+
+    If `is_login_page` is given, an html response that is the site login page
+    is deleted before it takes the destination's name, and its validators are
+    not stored.
+
     Parameters:
         url (str): The URL from which to download the file.
         destination (str): The path where the downloaded file will be saved.
+        session (requests.Session, optional): Session to download with. Defaults
+            to the pooled session for the current thread.
+        chunk_size (int): Bytes read from the response per write.
+        timeout (float): Seconds to wait for the connection and each read.
+        segment_threshold (int, optional): Size in bytes above which the file is
+            downloaded in segments. None to always use a single stream.
+        segments (int): Number of parallel segments for large files.
+        validators (JsonCache, optional): Stored ETag, Last-Modified and
+            Content-Length for each url, updated after each download.
+        is_login_page (callable, optional): Called with the html of an html
+            response, returns True if it is the login page.
 
     Returns:
-        True if downloaded the file.
+        DownloadResult: The download details. True if downloaded the file.
     """
     full_destination = create_full_file_path(destination)
     check_directory(full_destination)
-    response = requests.get(url, timeout=8)
-    if response.status_code == 200:
-        with open(full_destination, "wb") as file:
-            file.write(response.content)
-            print(f"Written to: {full_destination}")
+    part_file = full_destination + ".part"
+    start_time = time.time()
+
+    if validators is not None and url in validators:
+        if not os.path.exists(part_file) and is_file_unchanged(
+            url, full_destination, validators.get(url), session, timeout
+        ):
+            result = DownloadResult(url=url, destination=full_destination)
+            result.is_downloaded = result.is_unchanged = True
+            result.bytes_saved = os.path.getsize(full_destination)
+            result.duration = time.time() - start_time
+            print(f"Unchanged, not downloaded: {full_destination}")
+            return result
+
+    # Each retry continues the partial file left by the failed try.
+    result = retry_policy.DOWNLOAD_POLICY.call(
+        download_file_stream,
+        url,
+        full_destination,
+        session,
+        chunk_size,
+        timeout,
+        segment_threshold,
+        segments,
+        is_login_page,
+        host=rate_limiter.get_host(url),
+        should_retry=is_retryable_download,
+    )
+
+    if result and validators is not None:
+        validators.set(
+            url,
+            {
+                "etag": result.etag,
+                "last_modified": result.last_modified,
+                "content_length": os.path.getsize(full_destination),
+            },
+        )
+    return result
+
+
+def download_file_stream(
+    url,
+    full_destination,
+    session=None,
+    chunk_size=256 * 1024,
+    timeout=8,
+    segment_threshold=None,
+    segments=4,
+    is_login_page=None,
+):
+    """Streams a url to '<full_destination>.part', resuming it if it exists.
+
+    If the response is for a whole file larger than `segment_threshold` and the
+    server accepts ranges, the file is downloaded in segments instead (see
+    `download_file_segmented`). An html response that `is_login_page` finds to
+    be the login page is deleted instead of renamed to full_destination.
+
+    See `download_file`, which should normally be used instead.
+
+    Returns:
+        DownloadResult: The download details.
+    """
+    part_file = full_destination + ".part"
+    result = DownloadResult(url=url, destination=full_destination)
+    start_time = time.time()
+
+    resume_from = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+    try:
+        with (session or transport.get_session()).get(
+            url, headers=headers, stream=True, timeout=timeout
+        ) as response:
+            result.status_code = response.status_code
+            if response.status_code == 416 and resume_from:
+                # The '.part' file does not match the file on the server.
+                os.remove(part_file)
+                return download_file_stream(
+                    url,
+                    full_destination,
+                    session,
+                    chunk_size,
+                    timeout,
+                    segment_threshold,
+                    segments,
+                    is_login_page,
+                )
+            if response.status_code not in (200, 206):
+                logger.error(
+                    "Failed to download file (%s) status: %s", url, response.status_code
+                )
+                return result
+
+            if (
+                segment_threshold
+                and segments > 1
+                and response.status_code == 200
+                and is_segmentable(response, segment_threshold)
+            ):
+                return download_file_segmented(
+                    url, full_destination, response, segments, chunk_size, timeout
+                )
+
+            result.is_resumed = response.status_code == 206
+            result.etag = response.headers.get("ETag")
+            result.last_modified = response.headers.get("Last-Modified")
+            is_html = "text/html" in response.headers.get("Content-Type", "")
+            expected_size = -1  # Content-Length is the compressed size if encoded.
+            if "Content-Encoding" not in response.headers:
+                expected_size = int(response.headers.get("Content-Length", -1))
+            mode = "ab" if result.is_resumed else "wb"
+            with open(part_file, mode) as file:
+                for chunk in response.iter_content(chunk_size):
+                    file.write(chunk)
+                    result.bytes_written += len(chunk)
+    except requests.RequestException as e:
+        logger.error("Download interrupted (%s), partial file kept: %s", url, e)
+        result.duration = time.time() - start_time
+        return result
+
+    result.duration = time.time() - start_time
+    if expected_size >= 0 and result.bytes_written != expected_size:
+        logger.error(
+            "Incomplete download (%s): %s of %s bytes, partial file kept.",
+            url,
+            result.bytes_written,
+            expected_size,
+        )
+        return result
+
+    if is_login_page and is_html and is_login_file(part_file, is_login_page):
+        os.remove(part_file)
+        result.is_login_page = True
+        logger.error("Login page returned instead of the file (%s).", url)
+        return result
+
+    os.replace(part_file, full_destination)
+    result.is_downloaded = True
+    resumed_text = f" (resumed at {resume_from} bytes)" if result.is_resumed else ""
+    print(
+        f"Written to: {full_destination} : {result.bytes_written} bytes "
+        f"in {result.duration:.2f} s{resumed_text}"
+    )
+    return result
+
+
+def is_login_file(path, is_login_page):
+    """Returns True if a downloaded file is the site login page, as checked by
+    the is_login_page(html_content) callable."""
+    if os.path.getsize(path) > 1024 * 1024:
+        return False  # Too big to be the login page.
+    with open(path, "rb") as file:
+        return is_login_page(file.read().decode("utf-8", errors="ignore"))
+
+
+def is_retryable_download(result):
+    """Returns True if a failed download may work if tried again.
+
+    Downloads that were interrupted, incomplete, or got a temporary error status
+    are retried. Other errors, eg. 404, are not, nor is the login page, which
+    needs a new login first.
+    """
+    if result.is_downloaded or result.is_login_page:
+        return False
+    return result.status_code in (None, 200, 206) + retry_policy.RETRYABLE_STATUS_CODES
+
+
+def is_file_unchanged(url, full_destination, stored, session=None, timeout=8):
+    """Checks if a downloaded file is the same as the file on the server.
+
+    Sends a conditional HEAD request with the stored ETag / Last-Modified. The
+    file is unchanged if the server answers 304 Not Modified, or if it ignores
+    the condition but its validators and length match the stored ones and the
+    local file.
+
+    Parameters:
+        url (str): The file URL.
+        full_destination (str): The path of the downloaded file.
+        stored (dict): The 'etag', 'last_modified' and 'content_length' saved
+            when the file was downloaded.
+
+    Returns:
+        bool: True if the file does not need to be downloaded again.
+    """
+    if not os.path.exists(full_destination):
+        return False
+    local_size = os.path.getsize(full_destination)
+    if stored.get("content_length") != local_size:
+        return False
+
+    headers = {}
+    if stored.get("etag"):
+        headers["If-None-Match"] = stored["etag"]
+    if stored.get("last_modified"):
+        headers["If-Modified-Since"] = stored["last_modified"]
+    try:
+        response = (session or transport.get_session()).head(
+            url, headers=headers, allow_redirects=True, timeout=timeout
+        )
+    except requests.RequestException:
+        return False
+    if response.status_code == 304:
         return True
-    else:
-        logger.error(f"Failed to download file (%s)", url)
+    if response.status_code != 200:
         return False
+    if response.headers.get("Content-Length") != str(local_size):
+        return False
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if stored.get("etag") or etag:
+        return etag == stored.get("etag")
+    if stored.get("last_modified") or last_modified:
+        return last_modified == stored.get("last_modified")
+    return True  # No validators from the server, so the sizes must do.
+
+
+def is_segmentable(response, segment_threshold):
+    """Returns True if a GET response is for a file larger than segment_threshold
+    bytes, from a server that accepts byte ranges."""
+    if "Content-Encoding" in response.headers:
+        return False  # Content-Length is then the compressed size.
+    size = int(response.headers.get("Content-Length", 0))
+    accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return accepts_ranges and size > segment_threshold
+
+
+def download_file_segmented(
+    url, full_destination, response, segments=4, chunk_size=256 * 1024, timeout=8
+):
+    """Downloads a large file as parallel byte-range segments.
+
+    Called by `download_file_stream` with the file's GET response, whose body
+    is not read: its headers give the size and final url (see
+    `is_segmentable`). Each segment is streamed by its own thread (and pooled
+    session) to '<destination>.part<n>', which is continued if left from an
+    earlier run. The segments are then joined into '<destination>.part', the
+    total length is checked, and the file is renamed to the destination.
+
+    Parameters:
+        url (str): The URL from which to download the file.
+        full_destination (str): The full path to save the file to.
+        response (requests.Response): The GET response for the whole file.
+        segments (int): The number of segments.
+        chunk_size (int): Bytes read from the response per write.
+        timeout (float): Seconds to wait for the connection and each read.
+
+    Returns:
+        DownloadResult: The download details.
+    """
+    result = DownloadResult(url=url, destination=full_destination)
+    start_time = time.time()
+    size = int(response.headers["Content-Length"])
+
+    result.etag = response.headers.get("ETag")
+    result.last_modified = response.headers.get("Last-Modified")
+    final_url = response.url  # Segments go straight to the redirected url.
+    segment_size = -(-size // segments)  # Ceiling division.
+    ranges = [
+        (start, min(start + segment_size, size) - 1)
+        for start in range(0, size, segment_size)
+    ]
+    segment_files = [f"{full_destination}.part{i}" for i in range(len(ranges))]
+
+    def download_segment(index):
+        """Streams one byte range, continuing a partial segment file."""
+        start, end = ranges[index]
+        segment_file = segment_files[index]
+        done = os.path.getsize(segment_file) if os.path.exists(segment_file) else 0
+        if start + done > end:
+            return 0, done > 0
+        headers = {"Range": f"bytes={start + done}-{end}"}
+        written = 0
+        # Retried by HTTP_POLICY: nothing is written before the 206 response.
+        with transport.get(
+            final_url, headers=headers, stream=True, timeout=timeout
+        ) as segment_response:
+            if segment_response.status_code != 206:
+                raise requests.HTTPError(
+                    f"Range request returned {segment_response.status_code}"
+                )
+            with open(segment_file, "ab") as file:
+                for chunk in segment_response.iter_content(chunk_size):
+                    file.write(chunk)
+                    written += len(chunk)
+        return written, done > 0
+
+    print(f"Downloading {size} bytes in {len(ranges)} segments: {full_destination}")
+    result.status_code = 206
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            for written, is_resumed in executor.map(
+                download_segment, range(len(ranges))
+            ):
+                result.bytes_written += written
+                result.is_resumed = result.is_resumed or is_resumed
+    except requests.RequestException as e:
+        logger.error("Segment download failed (%s), segments kept: %s", url, e)
+        result.duration = time.time() - start_time
+        return result
+
+    total = sum(os.path.getsize(segment_file) for segment_file in segment_files)
+    if total != size:
+        logger.error("Segments total %s bytes, expected %s (%s).", total, size, url)
+        for segment_file in segment_files:
+            os.remove(segment_file)
+        result.duration = time.time() - start_time
+        return result
+
+    part_file = full_destination + ".part"
+    with open(part_file, "wb") as file:
+        for segment_file in segment_files:
+            with open(segment_file, "rb") as segment:
+                shutil.copyfileobj(segment, file)
+    for segment_file in segment_files:
+        os.remove(segment_file)
+    os.replace(part_file, full_destination)
+
+    result.is_downloaded = True
+    result.duration = time.time() - start_time
+    print(
+        f"Written to: {full_destination} : {result.bytes_written} bytes "
+        f"in {result.duration:.2f} s ({len(ranges)} segments)"
+    )
+    return result
 
 
 def print_now():
@@ -277,7 +680,7 @@ def check_directory(file_name):
     """Create the directory if it doesn't exist."""
     directory = os.path.dirname(file_name)
     if not os.path.exists(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)  # Other threads may create it too.
 
 
 def save_page(page_content, file_name):
@@ -309,6 +712,55 @@ def read_json(filename):
         return json.load(f)
 
 
+class JsonCache:
+    """A thread-safe dictionary that is saved to a JSON file.
+
+    Example:
+        cache = JsonCache("sps_downloads/ibs/quotes/lookup_cache.json")
+        if "13237" not in cache:
+            cache.set("13237", links)
+        cache.save()
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__lock = threading.Lock()
+        self.__data = read_json(filename) if is_file_exists(filename) else {}
+        self.__is_changed = False
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__data
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__data)
+
+    def get(self, key, default=None):
+        """Gets the value for a key, or the default."""
+        with self.__lock:
+            return self.__data.get(key, default)
+
+    def set(self, key, value):
+        """Sets the value for a key. Call `save()` to write the file."""
+        with self.__lock:
+            self.__data[key] = value
+            self.__is_changed = True
+
+    def delete(self, key):
+        """Removes a key, if it is there. Call `save()` to write the file."""
+        with self.__lock:
+            if self.__data.pop(key, None) is not None:
+                self.__is_changed = True
+
+    def save(self):
+        """Writes the cache to its JSON file, if it changed since last saved."""
+        with self.__lock:
+            if self.__is_changed:
+                save_json(self.__data, self.filename)
+                self.__is_changed = False
+
+
 def get_file_list(directory, qty=None):
     """
     This function retrieves the contents of a specified number of HTML files in a directory.
@@ -393,19 +845,44 @@ def move_file(filename, new_filename):
     # Use case-insensitive filename search
     full_filename = find_case_insensitive_filename(full_filename) or full_filename
 
-    for i in range(20):
-        try:
-            shutil.move(full_filename, full_new_filename)
+    # The file may still be downloading, so wait for it with retries.
+    try:
+        retry_policy.FILE_POLICY.call(shutil.move, full_filename, full_new_filename)
+    except FileNotFoundError as e:
+        # Create a FAIL file after the failed attempts
+        failed_name = create_failed_file(full_new_filename)
+        print(f"failed: {failed_name} - err FileNotFoundError: {e}")
+
+
+def link_file(source, destination):
+    """Hardlinks a file to a new path, or copies it if a hardlink is not possible.
+
+    Args:
+        source (str): The full path of the existing file.
+        destination (str): The full path for the link. Replaced if it exists.
+    """
+    check_directory(destination)
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
             return
-        except FileNotFoundError as e:
-            if i == 19:
-                # Create a FAIL file after 5 failed attempts
-                failed_name = get_failed_filename(full_new_filename)
-                check_directory(failed_name)
-                with open(failed_name, "w"):
-                    pass
-                print(f"failed: {failed_name} - err FileNotFoundError: {e}")
-            time.sleep(0.5)
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:  # Eg. a different device, or links not supported.
+        shutil.copy2(source, destination)
+
+
+def create_failed_file(path):
+    """Creates the empty FAIL file for a file that could not be downloaded.
+
+    Returns:
+        str: The FAIL file name.
+    """
+    failed_name = get_failed_filename(path)
+    check_directory(failed_name)
+    with open(failed_name, "w"):
+        pass
+    return failed_name
 
 
 def get_failed_filename(path):
@@ -0,0 +1,177 @@
+"""Per-host adaptive concurrency limits shared by the HTTP and browser fetches.
+
+Each host (eg. the subsidiary's `LogonDataClass.url`) has one `AdaptiveLimiter`.
+Every fetch to the host takes a slot from it, and reports how long the fetch
+took and whether it failed. The limit grows by about one slot per round of
+fast, successful fetches (additive increase), and is cut when the latency rises
+well above the best seen or the host returns errors (multiplicative decrease).
+So the number of fetches in flight settles at what the host can sustain,
+without tuning it per subsidiary.
+
+Example:
+    import modules.rate_limiter as rate_limiter
+
+    limiter = rate_limiter.get_limiter(st.current_logon.url)
+    limiter.acquire()
+    start = time.time()
+    ...
+    limiter.release(time.time() - start, is_error=False)
+"""
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+MIN_LIMIT = 2  # Fetches in flight per host never drop below this.
+MAX_LIMIT = 64  # Or rise above this.
+INITIAL_LIMIT = 8
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for one host.
+
+    Attributes:
+        host (str): The host the limit is for.
+        limit (float): The current number of fetches allowed in flight.
+        min_limit (int): The lowest the limit can go.
+        max_limit (int): The highest the limit can go.
+        latency_tolerance (float): A fetch is slow if its latency is more than
+            this many times the best average latency seen.
+        decrease_factor (float): The limit is multiplied by this on an error.
+        in_use (int): The number of fetches in flight.
+        requests (int): Fetches reported.
+        errors (int): Fetches that failed.
+    """
+
+    def __init__(
+        self,
+        host,
+        initial_limit=INITIAL_LIMIT,
+        min_limit=MIN_LIMIT,
+        max_limit=MAX_LIMIT,
+        latency_tolerance=2.0,
+        decrease_factor=0.5,
+    ):
+        self.host = host
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.in_use = 0
+        self.requests = 0
+        self.errors = 0
+        self.__average_latency = None
+        self.__best_latency = None
+        self.__last_decrease = 0
+        self.__condition = threading.Condition()
+
+    def get_limit(self):
+        """Returns the current limit as a whole number of fetches."""
+        with self.__condition:
+            return int(self.limit)
+
+    def acquire(self):
+        """Waits for a free slot and takes it."""
+        with self.__condition:
+            while self.in_use >= int(self.limit):
+                self.__condition.wait()
+            self.in_use += 1
+
+    def release(self, latency, is_error=False):
+        """Frees a slot and records how the fetch went.
+
+        Args:
+            latency (float): The seconds the fetch took.
+            is_error (bool): True if the fetch failed or the host was overloaded,
+                eg. a timeout, a 429 or a 5xx response.
+        """
+        with self.__condition:
+            self.in_use -= 1
+            self.__record(latency, is_error)
+            self.__condition.notify_all()
+
+    def record(self, latency, is_error=False):
+        """Records a fetch that did not take a slot, eg. a browser tab in a chunk."""
+        with self.__condition:
+            self.__record(latency, is_error)
+            self.__condition.notify_all()
+
+    def __record(self, latency, is_error):
+        """Adjusts the limit from one fetch. Must hold the condition lock."""
+        self.requests += 1
+        if is_error:
+            self.errors += 1
+            self.__decrease()
+            return
+
+        if self.__average_latency is None:
+            self.__average_latency = latency
+        else:
+            self.__average_latency = 0.8 * self.__average_latency + 0.2 * latency
+        if self.__best_latency is None or self.__average_latency < self.__best_latency:
+            self.__best_latency = self.__average_latency
+
+        if self.__average_latency > self.__best_latency * self.latency_tolerance:
+            self.__decrease()
+        else:
+            # About one more slot per round of `limit` good fetches.
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def __decrease(self):
+        """Cuts the limit, at most once per average latency so a burst of
+        failures from the same round only counts once."""
+        now = time.time()
+        if now - self.__last_decrease < (self.__average_latency or 0):
+            return
+        self.__last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        if self.__best_latency is not None:
+            # Let the baseline drift up, in case the host is just slower now.
+            self.__best_latency *= 1.1
+
+    def get_stats(self):
+        """Returns the limiter counters as a dict."""
+        with self.__condition:
+            return {
+                "host": self.host,
+                "limit": int(self.limit),
+                "in_use": self.in_use,
+                "requests": self.requests,
+                "errors": self.errors,
+                "average_latency": self.__average_latency,
+            }
+
+
+def get_host(url):
+    """Returns the host of a url, eg. 'ibs.stoneprofits.com'."""
+    if "//" not in url:
+        url = "http://" + url
+    return urlsplit(url).netloc.lower()
+
+
+def get_limiter(url):
+    """Returns the limiter for the url's host, creating it if needed."""
+    host = get_host(url)
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = AdaptiveLimiter(host)
+        return limiter
+
+
+def print_stats():
+    """Prints the limit, requests and errors for each host."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    for limiter in limiters:
+        stats = limiter.get_stats()
+        latency = stats["average_latency"] or 0
+        print(
+            f"Rate limiter {stats['host']}: limit {stats['limit']}, "
+            f"{stats['requests']} requests, {stats['errors']} errors, "
+            f"average latency {latency:.2f} s."
+        )
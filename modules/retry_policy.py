@@ -0,0 +1,247 @@
+"""One retry layer for the fetches, downloads, logins and file moves.
+
+A `RetryPolicy` retries a call with jittered exponential backoff, when it
+raises one of the retryable exceptions or its result is not good enough (eg. a
+503 response). Each policy has a retry budget: retries are limited to a share
+of all its calls, so a long run with a failing site does not spend most of its
+time retrying.
+
+Calls to a host also go through that host's `CircuitBreaker`. After repeated
+failures the breaker opens and calls to the host wait until it has had time to
+recover. It is then half-open: one call is let through to test the host while
+the others keep waiting, and its result closes or opens the breaker again.
+
+Example:
+    import modules.retry_policy as retry_policy
+
+    response = retry_policy.HTTP_POLICY.call(
+        session.get,
+        url,
+        timeout=30,
+        host="ibs.stoneprofits.com",
+        should_retry=retry_policy.is_retryable_response,
+    )
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """Pauses the calls to a host after repeated failures.
+
+    Attributes:
+        host (str): The host the breaker is for.
+        failure_threshold (int): Consecutive failures that open the breaker.
+        reset_timeout (float): Seconds the host is paused for when opened, and
+            the most a test call may take before another one is let through.
+        failures (int): The current number of consecutive failures.
+        state (str): "closed", "open", or "half-open" while a call tests the
+            host.
+        open_until (float): The time the pause, or the test call, ends.
+    """
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = "closed"
+        self.open_until = 0
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        """Waits while the breaker is open, or another call is testing the host.
+
+        When the pause is over, the calling thread is the one let through to
+        test the host.
+        """
+        while True:
+            with self.__lock:
+                if self.state == "closed":
+                    return
+                remaining = self.open_until - time.time()
+                if remaining <= 0:
+                    # Also when a test call never reported back.
+                    self.state = "half-open"
+                    self.open_until = time.time() + self.reset_timeout
+                    return
+            time.sleep(min(remaining, 1))
+
+    def record_success(self):
+        """Closes the breaker."""
+        with self.__lock:
+            self.failures = 0
+            self.state = "closed"
+            self.open_until = 0
+
+    def record_failure(self):
+        """Counts a failure, and opens the breaker at the threshold, or when the
+        test call failed."""
+        with self.__lock:
+            if self.state == "open":
+                return  # A call started before the breaker opened.
+            self.failures += 1
+            if self.state == "closed" and self.failures < self.failure_threshold:
+                return
+            self.state = "open"
+            self.open_until = time.time() + self.reset_timeout
+        logger.warning(
+            "Circuit breaker open for %s: pausing for %s s.",
+            self.host,
+            self.reset_timeout,
+        )
+
+
+def get_breaker(host):
+    """Returns the circuit breaker for a host, creating it if needed."""
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+class RetryPolicy:
+    """Retries calls with jittered exponential backoff and a retry budget.
+
+    Attributes:
+        name (str): The policy name, for the log.
+        max_attempts (int): The most times a call is tried.
+        base_delay (float): Seconds before the first retry. Doubles each retry.
+        max_delay (float): The longest delay between tries.
+        retry_exceptions (tuple): Exception types that are retried.
+        budget_ratio (float): Retries allowed as a share of all the calls. None
+            for no budget.
+        min_budget (int): Retries always allowed, on top of the share.
+        calls (int): The calls made through the policy.
+        retries (int): The retries made.
+    """
+
+    def __init__(
+        self,
+        name,
+        max_attempts=4,
+        base_delay=0.5,
+        max_delay=30,
+        retry_exceptions=(requests.RequestException,),
+        budget_ratio=0.2,
+        min_budget=10,
+    ):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_exceptions = retry_exceptions
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+        self.calls = 0
+        self.retries = 0
+        self.__lock = threading.Lock()
+
+    def get_delay(self, attempt):
+        """Returns the seconds to wait before a retry ("full jitter" backoff)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, function, *args, host=None, should_retry=None, **kwargs):
+        """Calls the function, retrying it if it fails.
+
+        Args:
+            function (callable): Called as function(*args, **kwargs).
+            host (str, optional): The host called, for its circuit breaker.
+            should_retry (callable, optional): Called with the result, returns
+                True if the call failed and should be tried again.
+
+        Returns:
+            The function's result. The last result if all the tries failed.
+
+        Raises:
+            Exception: The last retryable exception if all the tries raised it,
+                or any other exception at once.
+        """
+        breaker = get_breaker(host) if host else None
+        with self.__lock:
+            self.calls += 1
+
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.wait()
+            try:
+                result = function(*args, **kwargs)
+                error = None
+                is_failed = bool(should_retry and should_retry(result))
+            except self.retry_exceptions as e:
+                error = e
+                is_failed = True
+
+            if breaker:
+                if is_failed:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            attempt += 1
+            if not is_failed or not self.__take_retry(attempt):
+                if error is not None:
+                    raise error
+                return result
+
+            delay = self.get_delay(attempt - 1)
+            logger.warning(
+                "%s: try %s of %s failed (%s), retrying in %.1f s.",
+                self.name,
+                attempt,
+                self.max_attempts,
+                error or "unsuccessful result",
+                delay,
+            )
+            time.sleep(delay)
+
+    def __take_retry(self, attempt):
+        """Returns True if another try is allowed, and counts it."""
+        if attempt >= self.max_attempts:
+            return False
+        with self.__lock:
+            if (
+                self.budget_ratio is not None
+                and self.retries >= self.min_budget + self.budget_ratio * self.calls
+            ):
+                logger.warning("%s: retry budget used up, not retrying.", self.name)
+                return False
+            self.retries += 1
+            return True
+
+
+def is_retryable_response(response):
+    """Returns True if the response is a temporary error, eg. 503."""
+    return response.status_code in RETRYABLE_STATUS_CODES
+
+
+# The policies used by the project.
+HTTP_POLICY = RetryPolicy("HTTP")
+# Requests that may not be safe to send twice, eg. a postback or a login: tried
+# once, but still through the host's circuit breaker.
+HTTP_NO_RETRY_POLICY = RetryPolicy("HTTP (no retry)", max_attempts=1)
+DOWNLOAD_POLICY = RetryPolicy("Download", max_attempts=5, base_delay=1)
+LOGIN_POLICY = RetryPolicy(
+    "Login", max_attempts=8, base_delay=2, max_delay=20, retry_exceptions=()
+)
+FILE_POLICY = RetryPolicy(
+    "File move",
+    max_attempts=20,
+    base_delay=0.1,
+    max_delay=1,
+    retry_exceptions=(FileNotFoundError,),
+    budget_ratio=None,  # Waiting for a browser download is not a site failure.
+)
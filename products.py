@@ -31,6 +31,7 @@ import threading
 
 import scrape_tools as st
 import modules.my_common_module as mymod
+import modules.http_transport as transport
 
 
 # pylint: disable=W0603
@@ -193,7 +194,9 @@ def save_images_with_threading(pages_file, reference_file_name, read_from_file=F
     else:
         items = get_image_list(pages_file, reference_file_name)
 
+    # An upper bound: the transport limits the requests in flight per host.
     run_with_threads(save_images, items[1:], 40)
+    transport.print_stats()
 
 
 def run_with_threads(function, input_list, num_threads):
@@ -255,4 +258,6 @@ def get_missing_files(reference_file_name):
         ref_row.insert(0, row_id)
         list.append(ref_row)
 
+    # An upper bound: the transport limits the requests in flight per host.
     run_with_threads(save_images, download_list, 30)
+    transport.print_stats()
@@ -49,7 +49,12 @@ def save_linked_pages():
     pages = mymod.read_json(TOP_LEVEL_PAGE_FILE)
     all_links = st.get_all_table_links(table, pages)
     links = all_links[1500:]
-    st.get_links_html_content(links, st.get_subtable_tabs(table), SUB_PAGES_DIRECTORY)
+    st.get_links_html_content(
+        links,
+        st.get_subtable_tabs(table),
+        SUB_PAGES_DIRECTORY,
+        st.get_subtable_ids(table),
+    )
 
 
 def start_browser():
@@ -3,23 +3,43 @@
 # pylint: disable=W0718 # broad-exception-caught
 # pylint: disable=W0612 # redfined-outer-name
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+import html
 import os
+import random
+import re
+import threading
 
-from urllib.parse import urljoin
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 import numpy as np
 import pandas as pd  # pylint: disable=E0401
+import requests
 from seleniumbase import Driver
 
 from bs4 import BeautifulSoup
 import modules.my_common_module as mymod
+import modules.http_transport as transport
+import modules.rate_limiter as rate_limiter
+import modules.retry_policy as retry_policy
 import table_info as ti
 
 
 # Globals.
 driver = None  # pylint: disable=C0103
+browser_profile = "headed"  # pylint: disable=C0103 # See start_browser().
+resource_blocking = False  # pylint: disable=C0103 # See set_resource_blocking().
+browser_data_dir = None  # pylint: disable=C0103 # Persistent Chrome user data dir.
+session_file = None  # pylint: disable=C0103 # See open_saved_connection().
+use_page_tables = False  # pylint: disable=C0103 # See get_page_html().
+log_cdp_events = False  # pylint: disable=C0103 # For devtools_downloads.py.
+download_directory = None  # pylint: disable=C0103 # See start_browser().
+page_load_strategy = "normal"  # pylint: disable=C0103 # See start_browser().
 logger = mymod.new_logger(__file__)
 current_logon = None  # pylint: disable=C0103
+login_count = 0  # pylint: disable=C0103 # Logins so far, see relogin().
+_login_lock = threading.Lock()
 table_info = ti.table_info  # pylint: disable=W0612 # redfined-outer-name
 IS_DEBUGGING = False
 
@@ -58,17 +78,220 @@ logons = [
     ),
 ]
 
+# Browser profiles for start_browser().
+BROWSER_PROFILES = {
+    "headed": {"driver_options": {"headed": True}, "block_resources": False},
+    "headless": {"driver_options": {"headless2": True}, "block_resources": True},
+    "xvfb": {"driver_options": {"xvfb": True}, "block_resources": True},
+}
+
+# Resources the site's pages do not need to be read, blocked by the headless
+# and xvfb profiles. Patterns for the CDP Network.setBlockedURLs command.
+BLOCKED_URL_PATTERNS = [
+    "*.css",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*.eot",
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.svg",
+    "*.ico",
+    "*.webp",
+    "*.mp4",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*hotjar.com*",
+    "*facebook.net*",
+]
 
-def start_browser():
-    """Starts a new web browser session."""
-    global driver  # pylint: disable=W0603
-    driver = Driver(
-        uc=True,
-        headed=True,
-        external_pdf=True,
-    )
+# Reads tables in the page and returns them as JSON, see get_page_tables().
+# Arguments: the table ids, and whether to fall back to the role="presentation"
+# table if none of them is found. Tables are matched like get_table(): an
+# exact id first, then an id containing the name. The cell text is normalized,
+# the link text is the anchor's first child unmodified, as get_table_links()
+# reads it from the page source.
+TABLE_SCRIPT = """
+const [tableIds, usePresentationTable] = arguments;
+const clean = (text) => text.replace(/\\s+/g, " ").trim();
+const readTable = (table) => ({
+  id: table.id || null,
+  role: table.getAttribute("role"),
+  rows: Array.from(table.querySelectorAll("tr"), (row) =>
+    Array.from(row.cells, (cell) => {
+      const link = cell.querySelector("a[href]");
+      return [
+        cell.tagName.toLowerCase(),
+        clean(cell.textContent),
+        link ? (link.firstChild ? link.firstChild.textContent : "") : null,
+        link ? link.getAttribute("href") : null,
+      ];
+    })
+  ),
+});
+const tables = [];
+for (const tableId of tableIds) {
+  const name = CSS.escape(tableId);
+  const table =
+    document.querySelector(`table[id="${name}"]`) ||
+    document.querySelector(`table[id*="${name}"]`);
+  if (table) tables.push(readTable(table));
+}
+if (!tables.length && usePresentationTable) {
+  const table = document.querySelector('table[role="presentation"]');
+  if (table) tables.push(readTable(table));
+}
+return {
+  isLoginPage: !!document.getElementById("cLogin_dbUsername"),
+  tables: tables,
+};
+"""
+
+
+def start_browser(profile=None):
+    """Starts a new web browser session.
+
+    Uses the Chrome user data directory `browser_data_dir` if it is set, so
+    the profile (cache, cookies) is kept between runs. Downloads are saved in
+    `download_directory` (under mymod.CODE_DIRECTORY) if it is set, else in
+    "downloaded_files/". The browser uses `page_load_strategy`: with "none" a
+    page load or a script in a loading tab does not wait for the tab to load.
+
+    Args:
+        profile (str): A key of BROWSER_PROFILES, default `browser_profile`.
+            'headed' is a visible Chrome window. 'headless' and 'xvfb' (a
+            virtual display) do not render to a screen, and block the resources
+            in BLOCKED_URL_PATTERNS.
+    """
+    global driver, browser_profile, resource_blocking  # pylint: disable=W0603
+    profile = profile or browser_profile
+    resource_blocking = False
+    settings = BROWSER_PROFILES[profile]
+    options = dict(settings["driver_options"])
+    if browser_data_dir:
+        options["user_data_dir"] = mymod.create_full_file_path(browser_data_dir)
+    if log_cdp_events:
+        options["log_cdp_events"] = True
+    if page_load_strategy != "normal":
+        options["pls"] = page_load_strategy
+    driver = Driver(uc=True, external_pdf=True, **options)
     driver.ad_block = True
     driver.image_block = True
+    if download_directory:
+        directory = mymod.create_full_file_path(
+            download_directory, mymod.CODE_DIRECTORY
+        )
+        os.makedirs(directory, exist_ok=True)
+        driver.execute_cdp_cmd(
+            "Browser.setDownloadBehavior",
+            {"behavior": "allow", "downloadPath": directory},
+        )
+    browser_profile = profile
+    if settings["block_resources"]:
+        set_resource_blocking(True)
+    logger.info("Started browser with the '%s' profile.", profile)
+
+
+def set_resource_blocking(enabled):
+    """Blocks (or unblocks) BLOCKED_URL_PATTERNS in the browser's network layer.
+
+    Pages then load without stylesheets, fonts, images or analytics, which are
+    not needed to read their html. Turn it off before downloading attachments
+    in the browser, as an attachment may match a pattern (eg. '*.png').
+
+    The patterns are set in the current tab. A new tab does not block anything
+    until `apply_resource_blocking` is called in it.
+    """
+    global resource_blocking  # pylint: disable=W0603
+    resource_blocking = enabled
+    apply_resource_blocking(is_forced=True)
+
+
+def apply_resource_blocking(is_forced=False):
+    """Sets `resource_blocking` in the current tab, eg. a tab just opened.
+
+    Network.setBlockedURLs only applies to the tab it is sent to.
+
+    Args:
+        is_forced (bool): Also send it when not blocking, to unblock a tab that
+            was blocking. A new tab blocks nothing, so it is not needed there.
+    """
+    if not resource_blocking and not is_forced:
+        return
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd(
+        "Network.setBlockedURLs",
+        {"urls": BLOCKED_URL_PATTERNS if resource_blocking else []},
+    )
+
+
+def get_browser_pids():
+    """Returns the process ids of chromedriver and Chrome, and all the
+    processes under them, read from /proc, so only on Linux. Empty if there is
+    no browser.
+
+    In uc mode Chrome is started detached, not under chromedriver, so its tree
+    is walked from `driver.browser_pid` too.
+    """
+    if not driver or not os.path.isdir("/proc"):
+        return []
+    children = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat", encoding="utf-8") as file:
+                stat = file.read()
+        except OSError:
+            continue  # The process ended.
+        parent_pid = stat.rsplit(")", 1)[1].split()[1]
+        children.setdefault(parent_pid, []).append(pid)
+
+    pids = []
+    to_visit = [str(driver.service.process.pid)]
+    if getattr(driver, "browser_pid", None):
+        to_visit.append(str(driver.browser_pid))
+    while to_visit:
+        pid = to_visit.pop()
+        if int(pid) in pids:
+            continue
+        pids.append(int(pid))
+        to_visit.extend(children.get(pid, []))
+    return pids
+
+
+def get_browser_rss():
+    """Returns the memory (resident set size, bytes) used by the browser.
+
+    The total for chromedriver and all the Chrome processes (see
+    `get_browser_pids`). Returns 0
+    if there is no browser, or not on Linux.
+    """
+    rss = 0
+    for pid in get_browser_pids():
+        try:
+            with open(f"/proc/{pid}/statm", encoding="utf-8") as file:
+                rss += int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            continue
+    return rss
+
+
+def get_available_memory():
+    """Returns the system memory (bytes) available for new processes, read from
+    /proc/meminfo. Returns None if not on Linux."""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
 
 
 def open_connection(logon: LogonDataClass = logons[0]):
@@ -90,17 +313,24 @@ def open_connection(logon: LogonDataClass = logons[0]):
     # driver.uc_open(logon.url)
     driver.open(logon.url)
 
-    timeouts = [10.1, 11.1, 11.2, 9.3, 14.6, 8.2, 7.2, 20]
-    for timeout in timeouts:
-        driver.uc_open_with_reconnect(logon.url, timeout)
+    def open_login_page():
+        reconnect_time = random.uniform(7, 15)
+        driver.uc_open_with_reconnect(logon.url, reconnect_time)
         # driver.get(logon.url)
         # driver.sleep(timeout)
         if driver.is_element_present("#cLogin_dbUsername"):
-            break
-        else:
-            print(
-                f"Login element not found after retrying with {timeout} seconds timeout."
-            )
+            return True
+        print(
+            f"Login element not found after retrying with {reconnect_time:.1f} "
+            "seconds timeout."
+        )
+        return False
+
+    retry_policy.LOGIN_POLICY.call(
+        open_login_page,
+        host=rate_limiter.get_host(logon.url),
+        should_retry=lambda is_open: not is_open,
+    )
 
     # driver.get(logon.url)
 
@@ -121,6 +351,410 @@ def open_connection(logon: LogonDataClass = logons[0]):
     return driver
 
 
+def open_http_connection(logon: LogonDataClass = logons[0]):
+    """Logs in over HTTP, without a browser, by posting the ASP.NET login form.
+
+    The login page is fetched, all its form fields (including the hidden
+    __VIEWSTATE and __EVENTVALIDATION) are posted back with the username and
+    password, and the login cookies are kept in the shared HTTP transport.
+
+    Args:
+        logon (LogonDataClass): The logon information.
+
+    Returns:
+        requests.Session: The logged-in session for the current thread.
+
+    Raises:
+        ConnectionError: If the login page is returned again after posting.
+    """
+    global current_logon  # pylint: disable=W0603
+    if not logon.url.startswith("http"):
+        logon.url = "http://" + logon.url
+
+    logger.info("Opening HTTP connection '%s' to url: (%s)", logon.name, logon.url)
+    session = transport.get_session()
+    response = transport.get(logon.url, timeout=20)
+    response.raise_for_status()
+
+    soup = BeautifulSoup(response.text, "lxml")
+    form_data, action_url = get_form_data(soup, response.url)
+    form_data[get_input_name(soup, "cLogin_dbUsername")] = logon.username
+    form_data[get_input_name(soup, "cLogin_dbPassword")] = logon.password
+
+    button = soup.find(id="buttonLogin")
+    if button and button.name == "a":
+        form_data["__EVENTTARGET"], form_data["__EVENTARGUMENT"] = (
+            get_postback_arguments(button.get("href", ""))
+        )
+    elif button and button.get("name"):
+        form_data[button["name"]] = button.get("value", "")
+
+    response = transport.post(action_url, data=form_data, timeout=20)
+    response.raise_for_status()
+    if is_login_page(response.text):
+        raise ConnectionError(f"HTTP login failed for '{logon.name}'.")
+
+    current_logon = logon
+    logger.info("HTTP connection opened.")
+    return session
+
+
+def open_saved_connection(logon: LogonDataClass, filename, use_browser=True):
+    """Logs in by reusing a saved session, if the site still accepts it.
+
+    The session cookies saved in `filename` (see `save_session`) are loaded,
+    and the logon page is requested. If it answers with a logged-in page (see
+    `is_saved_session_valid`), the session is still valid and no login is
+    needed. Otherwise logs in as usual, with
+    `open_connection` or `open_http_connection`, and saves the new session.
+    `relogin` also saves the session to the file.
+
+    Args:
+        logon (LogonDataClass): The logon information.
+        filename (str): The JSON file of the saved cookies, eg.
+            'sps_downloads/ibs/session_cookies.json'.
+        use_browser (bool): Whether to log in the browser, or only over HTTP.
+    """
+    global current_logon, session_file  # pylint: disable=W0603
+    session_file = filename
+    if not logon.url.startswith("http"):
+        logon.url = "http://" + logon.url
+
+    if use_browser and not driver:
+        start_browser()
+    if is_saved_session_valid(logon, filename, use_browser):
+        current_logon = logon
+        logger.info("Reusing the saved session for '%s'.", logon.name)
+        load_browser_cookies()
+        return
+
+    if use_browser:
+        open_connection(logon)
+        load_browser_cookies()
+    else:
+        open_http_connection(logon)
+    save_session()
+
+
+def is_saved_session_valid(logon: LogonDataClass, filename, use_browser=True):
+    """Loads the saved session cookies, and checks if the site accepts them.
+
+    The browser opens the logon page like `open_connection` does, with
+    `uc_open_with_reconnect`. The page is then requested over HTTP with the
+    browser's cookies, as a bot check, error or blank page in the browser is
+    not the login page either.
+
+    Returns:
+        bool: True if the logon page answers 200 with a page that is not the
+            login page.
+    """
+    if use_browser and __open_logon_page(logon):
+        # A persistent browser profile was already logged in.
+        return True
+    if not mymod.is_file_exists(filename):
+        return False
+
+    cookies = mymod.read_json(filename)
+    if use_browser:
+        for cookie in cookies:
+            driver.add_cookie(
+                {
+                    key: value
+                    for key, value in cookie.items()
+                    if key in ("name", "value", "path", "secure", "httpOnly", "expiry")
+                }
+            )
+        return __open_logon_page(logon)
+
+    transport.set_cookies(cookies)
+    return __is_logged_in(logon, use_browser=False)
+
+
+def __open_logon_page(logon: LogonDataClass):
+    """Opens the logon page in the browser like `open_connection` does.
+
+    The page is opened again until it is either the login page or a logged-in
+    page, not a bot check or a blank page.
+
+    Returns:
+        bool: True if the browser is logged in.
+    """
+
+    def open_logon_page():
+        driver.uc_open_with_reconnect(logon.url, random.uniform(7, 15))
+        if __is_logged_in(logon, use_browser=True):
+            return True
+        # None: neither page was loaded, open it again.
+        return False if driver.is_element_present("#cLogin_dbUsername") else None
+
+    return (
+        retry_policy.LOGIN_POLICY.call(
+            open_logon_page,
+            host=rate_limiter.get_host(logon.url),
+            should_retry=lambda is_logged_in: is_logged_in is None,
+        )
+        is True
+    )
+
+
+def __is_logged_in(logon: LogonDataClass, use_browser):
+    """Returns True if the logon page, requested over HTTP (with the browser's
+    cookies if use_browser), answers 200 with a page that is not the login
+    page."""
+    if use_browser:
+        if is_login_page(driver.page_source):
+            return False
+        load_browser_cookies()
+    try:
+        response = transport.get(logon.url, timeout=20)
+    except requests.RequestException as e:
+        logger.error("Could not check the saved session: %s", e)
+        return False
+    return (
+        response.status_code == 200
+        and bool(response.text.strip())
+        and not is_login_page(response.text)
+    )
+
+
+def save_session(filename=None):
+    """Saves the login cookies to a JSON file, default `session_file`.
+
+    The browser's cookies if there is a browser, else the HTTP transport's.
+    """
+    filename = filename or session_file
+    if not filename:
+        return
+    if driver:
+        cookies = driver.get_cookies()
+    else:
+        cookies = [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path}
+            for c in transport.cookie_jar
+        ]
+    mymod.save_json(cookies, filename)
+
+
+def is_login_page(html_content):
+    """Returns True if the html is the site login page."""
+    return bool(re.search(r"id=[\"']?cLogin_dbUsername", html_content))
+
+
+def get_input_name(soup, element_id):
+    """Gets the form field name of an input, eg. 'cLogin$dbUsername'."""
+    element = soup.find(id=element_id)
+    return element.get("name", element_id) if element else element_id
+
+
+def get_postback_arguments(href):
+    """Gets the event target and argument from a "javascript:__doPostBack()" link.
+
+    >>> get_postback_arguments("javascript:__doPostBack('lnkNext','')")
+        ('lnkNext', '')
+    """
+    match = re.search(r"__doPostBack\(\s*'([^']*)'\s*,\s*'([^']*)'", href or "")
+    if match:
+        return match.group(1), match.group(2)
+    return "", ""
+
+
+def get_form_data(soup, page_url):
+    """Gets the field values a browser would post for the page's form.
+
+    Args:
+        soup (BeautifulSoup): The parsed page.
+        page_url (str): The url of the page, to resolve the form action.
+
+    Returns:
+        tuple: (dict of field name -> value, absolute url to post the form to).
+    """
+    form = soup.find("form") or soup
+    action_url = urljoin(page_url, form.get("action") or page_url)
+    form_data = {}
+    for element in form.find_all(["input", "select", "textarea"]):
+        name = element.get("name")
+        if not name:
+            continue
+        input_type = (element.get("type") or "text").lower()
+        if input_type in ("submit", "button", "image", "reset", "file"):
+            continue
+        if input_type in ("checkbox", "radio") and not element.has_attr("checked"):
+            continue
+        if element.name == "select":
+            option = element.find("option", selected=True) or element.find("option")
+            form_data[name] = option.get("value", option.text) if option else ""
+        elif element.name == "textarea":
+            form_data[name] = element.text
+        else:
+            form_data[name] = element.get("value", "")
+    return form_data, action_url
+
+
+def load_browser_cookies():
+    """Copies the browser's login cookies and user agent to the HTTP transport.
+
+    The browser must already be logged in with `open_connection`. After this,
+    sessions from `transport.get_session()` are accepted by the site as the
+    same logged-in user. Does nothing if there is no browser, for example after
+    `open_http_connection`.
+    """
+    if not driver:
+        return
+    user_agent = driver.execute_script("return navigator.userAgent;")
+    transport.set_default_headers({"User-Agent": user_agent})
+    transport.set_cookies(driver.get_cookies())
+    logger.info("Loaded %s browser cookies.", len(transport.cookie_jar))
+
+
+def relogin(seen_login_count=None):
+    """Logs in again with `current_logon`, after the session expired.
+
+    Uses the browser if there is one (and copies its new cookies to the HTTP
+    transport), otherwise logs in over HTTP. Threads that find the session
+    expired at the same time only log in once: each passes the `login_count`
+    it saw before its fetch, and if another thread has logged in since, this
+    does nothing.
+
+    Args:
+        seen_login_count (int, optional): `login_count` before the fetch that
+            found the login page.
+    """
+    global login_count  # pylint: disable=W0603
+    with _login_lock:
+        if seen_login_count is not None and seen_login_count != login_count:
+            return
+        logger.warning(
+            "Session expired, logging in again as '%s'.", current_logon.name
+        )
+        if driver:
+            open_connection(current_logon)
+            load_browser_cookies()
+        else:
+            open_http_connection(current_logon)
+        save_session()
+        login_count += 1
+
+
+def fetch_page(url, form_data=None, timeout=30):
+    """Gets a page over HTTP (or posts the form data), logging in again if needed.
+
+    If the site returns the login page, or redirects to it, the session has
+    expired: logs in again with `relogin` and fetches the page once more.
+
+    Args:
+        url (str): The page url.
+        form_data (dict, optional): Form fields to post, eg. for a postback.
+        timeout (float): Seconds to wait for the response.
+
+    Returns:
+        requests.Response: The page response.
+
+    Raises:
+        requests.HTTPError: If the response is an error status.
+        ConnectionError: If the login page is still returned after logging in.
+    """
+    for attempt in range(2):
+        seen_login_count = login_count
+        if form_data is None:
+            response = transport.get(url, timeout=timeout)
+        else:
+            response = transport.post(url, data=form_data, timeout=timeout)
+        response.raise_for_status()
+        if not is_login_page(response.text):
+            return response
+        if attempt == 0:
+            relogin(seen_login_count)
+    raise ConnectionError(f"Login page returned after logging in again: {url}")
+
+
+def get_page_source(url, table_ids=(), use_presentation_table=False):
+    """Returns the current tab's page source, logging in again if needed.
+
+    If the tab shows the login page, the session has expired: logs in again
+    with `relogin` and opens the url in the tab once more.
+
+    Args:
+        url (str): The url the tab was opened with.
+        table_ids, use_presentation_table: The tables to read instead of the
+            whole page with `use_page_tables`, see `get_page_html`.
+    """
+    seen_login_count = login_count
+    html_content = get_page_html(table_ids, use_presentation_table)
+    if not is_login_page(html_content):
+        return html_content
+    relogin(seen_login_count)
+    driver.open(url)
+    return get_page_html(table_ids, use_presentation_table)
+
+
+def get_page_html(table_ids=(), use_presentation_table=False):
+    """Returns the current tab's html.
+
+    With `use_page_tables` set, only the given tables are read in the page and
+    rebuilt as compact html (see `get_page_tables`), instead of sending the
+    whole page source from the browser. Otherwise, or with no table_ids, the
+    whole page source is returned.
+
+    Args:
+        table_ids (list): The ids of the tables to read, eg. ["tblFiles"].
+        use_presentation_table (bool): Whether to read the role="presentation"
+            table if none of the tables is found.
+    """
+    if not use_page_tables or not table_ids:
+        return driver.page_source
+    return tables_to_html(get_page_tables(table_ids, use_presentation_table))
+
+
+def get_page_tables(table_ids, use_presentation_table=False):
+    """Reads tables of the current tab with a script in the page.
+
+    Returns:
+        dict: {"isLoginPage": bool, "tables": [{"id", "role", "rows"}]}. Each
+            row is a list of cells, each cell is [tag, text, link text, href],
+            the link ones None if the cell has no link. The text has its
+            whitespace collapsed, the link text is the link's first child as
+            is.
+    """
+    table_ids = [table_id.lstrip("#") for table_id in table_ids]
+    return driver.execute_script(TABLE_SCRIPT, table_ids, use_presentation_table)
+
+
+def tables_to_html(page_tables):
+    """Rebuilds compact html from `get_page_tables`, which `get_table`,
+    `get_table_links` and `is_login_page` read like the page source."""
+    parts = ["<html><body>"]
+    if page_tables["isLoginPage"]:
+        parts.append('<input id="cLogin_dbUsername">')
+    for table in page_tables["tables"]:
+        attributes = ""
+        if table["id"]:
+            attributes += f' id="{html.escape(table["id"])}"'
+        if table["role"]:
+            attributes += f' role="{html.escape(table["role"])}"'
+        parts.append(f"<table{attributes}>")
+        for row in table["rows"]:
+            parts.append("<tr>")
+            for tag, text, link_text, href in row:
+                parts.append(f"<{tag}>{__cell_to_html(text, link_text, href)}</{tag}>")
+            parts.append("</tr>")
+        parts.append("</table>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def __cell_to_html(text, link_text, href):
+    """Returns the html of a cell's contents, with its link around the link text."""
+    if href is None:
+        return html.escape(text)
+    before, after = "", text
+    clean_link_text = " ".join(link_text.split())
+    if clean_link_text and clean_link_text in text:
+        before, _, after = text.partition(clean_link_text)
+    # get_table_links reads the link's first child, so it must not be empty.
+    link = f'<a href="{html.escape(href)}">{html.escape(link_text) or " "}</a>'
+    return html.escape(before) + link + html.escape(after)
+
+
 def get_table_links(table, column_number, secondary_column_number=None):
     """Extracts hyperlinks from specified columns of an HTML table.
 
@@ -284,6 +918,8 @@ def get_all_pages(url, table_id=""):
 
     Args:
         url (str): The URL of the starting webpage.
+        table_id (str): The id of the table on each page. With `use_page_tables`
+            only this table is kept, see `get_page_html`.
 
     Returns:
         list: A list containing the HTML content of all visited pages.
@@ -293,7 +929,8 @@ def get_all_pages(url, table_id=""):
                     or retrieving page content.
     """
     driver.open(get_full_url(url))
-    result = [driver.page_source]
+    table_ids = [table_id] if table_id else []
+    result = [get_page_html(table_ids)]
     xpath = "//a[@class='underline' and text()='Next']"
     if table_id.startswith("#"):
         table_id = table_id[1:]
@@ -316,7 +953,7 @@ def get_all_pages(url, table_id=""):
                 driver.wait_for_element(table_xpath, timeout=10)
             driver.click(xpath)
             driver.sleep(4)
-            result.append(driver.page_source)
+            result.append(get_page_html(table_ids))
             print(f"Added page html for page {counter}.")
 
         except Exception:
@@ -328,6 +965,433 @@ def get_all_pages(url, table_id=""):
     return result
 
 
+def get_all_pages_http(
+    url, table_id="", pipeline=True, on_page=None, raise_errors=False
+):
+    """Fetches the content of all list pages over HTTP, replaying the "Next" postback.
+
+    Works like `get_all_pages`, but instead of clicking the "Next" link in the
+    browser, it posts the page's form back with the link's __EVENTTARGET and
+    the current __VIEWSTATE. Needs a logged-in transport (see
+    `open_http_connection` or `load_browser_cookies`).
+
+    Args:
+        url (str): The URL of the starting webpage.
+        table_id (str): The id of the list table. If given, crawling stops at a
+            page without the table (eg. the login page).
+        pipeline (bool): If True, the request for the next page is sent before
+            the current page is checked and handed to `on_page`.
+        on_page (callable, optional): Called as on_page(page_number, html) for
+            each page, while the next page is being fetched.
+        raise_errors (bool): If True, a failed page request raises instead of
+            returning the pages fetched so far.
+
+    Returns:
+        list: A list containing the HTML content of all visited pages.
+    """
+    if table_id.startswith("#"):
+        table_id = table_id[1:]
+    page_url = get_full_url(url)
+    response = fetch_page(page_url)
+    html_content = response.text
+    page_url = response.url
+    result = []
+    executor = ThreadPoolExecutor(max_workers=1) if pipeline else None
+
+    def handle_page(page_number, html_content):
+        """Checks the page has the table and passes it to on_page."""
+        if table_id and not get_table(html_content, table_id):
+            logger.info("No table '%s' on page %s.", table_id, page_number)
+            return False
+        if on_page:
+            on_page(page_number, html_content)
+        return True
+
+    counter = 1
+    while True:
+        next_request = get_next_page_request(html_content, page_url)
+        if IS_DEBUGGING and counter > 1:
+            next_request = None  # Only do 2 pages if debugging.
+        future = None
+        if next_request and executor:
+            future = executor.submit(post_next_page, *next_request)
+
+        if not handle_page(counter, html_content):
+            break
+        result.append(html_content)
+        print(f"Added page html for page {counter}.", end="\r")
+
+        if not next_request:
+            break
+        try:
+            if future:
+                html_content, page_url = future.result()
+            else:
+                html_content, page_url = post_next_page(*next_request)
+        except requests.RequestException as e:
+            logger.error("Error getting page %s: %s", counter + 1, e)
+            if raise_errors:
+                raise
+            break
+        if html_content == result[-1]:
+            break  # The "Next" link did not change the page.
+        counter += 1
+
+    if executor:
+        executor.shutdown(wait=False)
+    print(f"Finished getting {len(result)} pages for url: {url}")
+    return result
+
+
+def get_all_pages_by_number(url, table_id="", page_param="page", max_workers=8):
+    """Fetches all list pages concurrently by page number over HTTP.
+
+    The first page is fetched and its total page count is read from the
+    'TotalPages_<list name>' element. Page 2 is fetched on its own with
+    `page_param` set to 2: if it lists the same rows as page 1, the list ignores
+    `page_param`. Otherwise the other pages are requested at the same time and
+    returned in order. A page that fails is tried once more, then left out and
+    logged. Falls back to `get_all_pages_http` if there is no page count, or the
+    list ignores `page_param`.
+
+    Args:
+        url (str): The URL of the first page.
+        table_id (str): The id of the list table.
+        page_param (str): The URL query parameter for the page number.
+        max_workers (int): The number of pages fetched at once.
+
+    Returns:
+        list: A list containing the HTML content of all the pages, in order.
+    """
+    page_url = get_full_url(url)
+    response = fetch_page(page_url)
+    first_page = response.text
+    total_pages = get_total_pages(first_page)
+    if not total_pages or not page_param:
+        print("No page count found, getting pages with the Next link.")
+        return get_all_pages_http(url, table_id)
+    if IS_DEBUGGING:
+        total_pages = min(total_pages, 2)
+
+    def fetch(page_number):
+        """Returns the page html, or None if the request failed."""
+        try:
+            page_response = fetch_page(
+                set_query_param(response.url, page_param, page_number)
+            )
+        except (requests.RequestException, ConnectionError) as e:
+            logger.error("Error getting page %s: %s", page_number, e)
+            return None
+        print(f"Got page {page_number} of {total_pages}.", end="\r")
+        return page_response.text
+
+    pages = {1: first_page}
+    if total_pages > 1:
+        pages[2] = fetch(2) or fetch(2)
+        if pages[2] is None:
+            print("Page 2 failed, getting pages with the Next link.")
+            return get_all_pages_http(url, table_id)
+        if get_page_link_urls(pages[2]) == get_page_link_urls(first_page):
+            logger.info("Page parameter '%s' not supported by: %s", page_param, url)
+            return get_all_pages_http(url, table_id)
+
+    print(f"Getting {total_pages} pages with {max_workers} workers.")
+    page_numbers = range(3, total_pages + 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages.update(zip(page_numbers, executor.map(fetch, page_numbers)))
+        failed = [number for number, page in pages.items() if page is None]
+        pages.update(zip(failed, executor.map(fetch, failed)))  # Try once more.
+    failed = [number for number, page in pages.items() if page is None]
+    if failed:
+        logger.error("Pages not fetched, left out: %s", failed)
+
+    result = [page for _, page in sorted(pages.items()) if page is not None]
+    if table_id:
+        missing = [
+            number
+            for number, page in sorted(pages.items())
+            if page is not None and not get_table(page, table_id)
+        ]
+        if missing:
+            logger.error("No table '%s' on pages: %s", table_id, missing)
+    print(f"Finished getting {len(result)} pages for url: {url}")
+    return result
+
+
+def get_total_pages(html_content):
+    """Reads the page count from the 'TotalPages_<list name>' element, or None."""
+    soup = BeautifulSoup(html_content, "lxml")
+    element = soup.find(id=re.compile(r"^TotalPages_"))
+    if not element:
+        return None
+    text = element.get("value") or element.get_text()
+    match = re.search(r"\d+", text)
+    return int(match.group()) if match else None
+
+
+def get_page_link_urls(html_content):
+    """Gets the urls of all links on a page, to compare two pages."""
+    soup = BeautifulSoup(html_content, "lxml")
+    return [a.get("href") for a in soup.find_all("a", href=True)]
+
+
+def set_query_param(url, name, value):
+    """Returns the url with a query parameter added or replaced.
+
+    >>> set_query_param("http://x/list.aspx?tab=4", "page", 3)
+        'http://x/list.aspx?tab=4&page=3'
+    """
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    query = [(key, val) for key, val in query if key != name] + [(name, str(value))]
+    return urlunsplit(parts._replace(query=urlencode(query, safe="/")))
+
+
+def get_all_pages_by_date_window(
+    url, table_id="", window_months=1, max_workers=8, retries=2
+):
+    """Fetches all list pages, crawling the list's date range in windows concurrently.
+
+    The ListStartDate/ListEndDate range in the url is split into windows of
+    `window_months` (see `get_date_window_urls`). Each window is crawled as its
+    own short "Next" chain with `get_all_pages_http`, several windows at once.
+    A failed window is retried on its own, up to `retries` more times.
+
+    Args:
+        url (str): The list url with ListStartDate and ListEndDate parameters.
+        table_id (str): The id of the list table.
+        window_months (int): The number of months in each window.
+        max_workers (int): The number of windows crawled at once.
+        retries (int): Extra attempts for a window that fails.
+
+    Returns:
+        list: The HTML content of all the pages, in date window order. A row
+            already listed in an earlier window is left out.
+    """
+    window_urls = get_date_window_urls(url, window_months)
+    if IS_DEBUGGING:
+        window_urls = window_urls[:2]
+
+    def crawl(window_url):
+        for attempt in range(retries + 1):
+            try:
+                return get_all_pages_http(window_url, table_id, raise_errors=True)
+            except requests.RequestException as e:
+                logger.error(
+                    "Window failed (attempt %s): %s : %s", attempt + 1, window_url, e
+                )
+        return None
+
+    print(f"Getting {len(window_urls)} date windows with {max_workers} workers.")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window_pages = list(executor.map(crawl, window_urls))
+
+    result = []
+    failed_windows = []
+    seen_rows = set()
+    for window_url, pages in zip(window_urls, window_pages):
+        if pages is None:
+            failed_windows.append(window_url)
+        else:
+            result.extend(drop_seen_rows(page, table_id, seen_rows) for page in pages)
+    if failed_windows:
+        logger.error("Date windows not crawled: %s", failed_windows)
+    print(f"Finished getting {len(result)} pages in {len(window_urls)} windows.")
+    return result
+
+
+def drop_seen_rows(html_content, table_id, seen_rows):
+    """Removes the table rows already seen in an earlier page, eg. a record
+    listed in two date windows.
+
+    Only rows with a link to a record are compared; header and pager rows are
+    kept.
+
+    Args:
+        html_content (str): The HTML content of a list page.
+        table_id (str): The id of the list table.
+        seen_rows (set): The rows seen so far, the new rows are added to it.
+
+    Returns:
+        str: The HTML content, without the rows seen before.
+    """
+    table = get_table(html_content, table_id)
+    if not table:
+        return html_content
+    is_changed = False
+    for row in table.find_all("tr"):
+        if not any(
+            not a["href"].startswith("javascript:")
+            for a in row.find_all("a", href=True)
+        ):
+            continue
+        key = str(row)
+        if key in seen_rows:
+            row.decompose()
+            is_changed = True
+        else:
+            seen_rows.add(key)
+    if not is_changed:
+        return html_content
+    return str(list(table.parents)[-1])
+
+
+def get_date_window_urls(url, window_months=1):
+    """Splits the ListStartDate/ListEndDate range of a list url into date windows.
+
+    >>> get_date_window_urls("/l.aspx?ListStartDate=1/1/2022&ListEndDate=2/15/2022")
+        ['/l.aspx?ListStartDate=1/1/2022&ListEndDate=1/31/2022',
+         '/l.aspx?ListStartDate=2/1/2022&ListEndDate=2/15/2022']
+
+    Returns:
+        list: The urls for each window, or [url] if it has no date range.
+    """
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    if "ListStartDate" not in query or "ListEndDate" not in query:
+        return [url]
+
+    date_format = "%m/%d/%Y"
+    start = datetime.strptime(query["ListStartDate"], date_format).date()
+    end = datetime.strptime(query["ListEndDate"], date_format).date()
+    result = []
+    while start <= end:
+        month = start.month - 1 + window_months
+        next_start = date(start.year + month // 12, month % 12 + 1, 1)
+        window_end = min(next_start - timedelta(days=1), end)
+        window_url = set_query_param(url, "ListStartDate", format_list_date(start))
+        window_url = set_query_param(
+            window_url, "ListEndDate", format_list_date(window_end)
+        )
+        result.append(window_url)
+        start = next_start
+    return result
+
+
+def format_list_date(value):
+    """Formats a date like the list urls do, eg. '1/31/2022'."""
+    return f"{value.month}/{value.day}/{value.year}"
+
+
+def search_records(
+    table_info: ti.TableInfoDataClass, search_values, cache=None, max_workers=8
+):
+    """Searches a list for specific transaction numbers, concurrently over HTTP.
+
+    Each value is looked up with the list's search (`get_search_url`) and the
+    links in the result table are returned. Values found are kept in `cache`,
+    so they are only searched for once.
+
+    Args:
+        table_info (TableInfoDataClass): The list to search.
+        search_values (list): The transaction numbers to look up.
+        cache (mymod.JsonCache, optional): Cache of value -> link rows.
+        max_workers (int): The number of searches run at once.
+
+    Returns:
+        tuple: (links, secondary_links) lists of LinkDataClass, like
+            `get_table_links`.
+    """
+
+    def search(search_value):
+        if cache is not None and search_value in cache:
+            return cache.get(search_value)
+        url = get_full_url(get_search_url(table_info, search_value))
+        response = fetch_page(url)
+        rows = []
+        table = get_table(response.text, table_info.table_id)
+        if table:
+            links, secondary_links = get_table_links(
+                table, table_info.column_number, table_info.secondary_column_number
+            )
+            rows = [
+                [get_link_text(link), link.url, get_link_text(second), second.url]
+                for link, second in zip(links, secondary_links)
+            ]
+        # A value not found is searched for again next time: it may be a new
+        # record, or the page may not have shown the result table.
+        if cache is not None and rows:
+            cache.set(search_value, rows)
+        return rows
+
+    result = []
+    secondary_result = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(search, value): value for value in search_values}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except requests.RequestException as e:
+                logger.error("Search failed for '%s': %s", futures[future], e)
+                continue
+            if not rows:
+                print(f"No record found for '{futures[future]}'.")
+            for text, url, secondary_text, secondary_url in rows:
+                result.append(LinkDataClass(displayed_text=text, url=url))
+                secondary_result.append(
+                    LinkDataClass(displayed_text=secondary_text, url=secondary_url)
+                )
+    if cache is not None:
+        cache.save()
+    return result, secondary_result
+
+
+def get_link_text(link: LinkDataClass):
+    """Gets the displayed text of a link as a plain string."""
+    return str(getattr(link.displayed_text, "text", link.displayed_text))
+
+
+def get_search_url(table_info: ti.TableInfoDataClass, search_value):
+    """Gets the list url that searches for one value, without the date range.
+
+    >>> get_search_url(ti.table_info["opportunities"], "13237")
+        '/listOpportunities.aspx?tab=0&list=ListOpportunities&searchBy=...'
+    """
+    url = table_info.url_path
+    parts = urlsplit(url)
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in ("ListStartDate", "ListEndDate")
+    ]
+    query += [
+        ("searchBy", table_info.search_by),
+        ("searchOperator", "="),
+        ("dbSearchValue1", str(search_value)),
+    ]
+    return urlunsplit(parts._replace(query=urlencode(query, safe="/")))
+
+
+def get_next_page_request(html_content, page_url):
+    """Gets the request for the page the "Next" link goes to.
+
+    Returns:
+        tuple: (url, form data) for a postback, (url, None) for a plain link,
+            or None if there is no "Next" link.
+    """
+    soup = BeautifulSoup(html_content, "lxml")
+    next_link = soup.find("a", class_="underline", string="Next")
+    if not next_link:
+        return None
+    href = next_link.get("href", "")
+    event_target, event_argument = get_postback_arguments(href)
+    if not event_target:
+        if not href or href.startswith("javascript"):
+            return None
+        return urljoin(page_url, href), None
+
+    form_data, action_url = get_form_data(soup, page_url)
+    form_data["__EVENTTARGET"] = event_target
+    form_data["__EVENTARGUMENT"] = event_argument
+    return action_url, form_data
+
+
+def post_next_page(url, form_data):
+    """Requests the next list page. Returns the html and the url it came from."""
+    response = fetch_page(url, form_data)
+    return response.text, response.url
+
+
 def get_subtable_data(table, parent_text, table_key_name):
     """Extracts and prepares subtable data from HTML content.
 
@@ -437,13 +1501,17 @@ def get_subtable_data_all(subtable_name, pages, table_key_name):
     return result
 
 
-def save_page_source(filename):
-    """Save the page html source to a file."""
-    mymod.save_page(driver.page_source, filename)
+def save_page_source(filename, table_ids=()):
+    """Save the page html source to a file (see `get_page_html`)."""
+    mymod.save_page(get_page_html(table_ids), filename)
 
 
-def get_links_html_content(links, tabs, save_dir):
-    """Open all links and get HTML content from each page."""
+def get_links_html_content(links, tabs, save_dir, table_ids=()):
+    """Open all links and get HTML content from each page.
+
+    With `use_page_tables` only the table_ids tables are saved, eg. the
+    subtables from `get_subtable_ids`.
+    """
 
     #     xpath = "//*[@id='tabs']/li[2]/a"
     #     driver.click(xpath)
@@ -473,7 +1541,7 @@ def get_links_html_content(links, tabs, save_dir):
         # pages[link.displayed_text] = driver.page_source
 
         filename = save_dir + link.displayed_text + ".html"
-        save_page_source(filename)
+        save_page_source(filename, table_ids)
         print(f"Completed page {index} of {len(links)} :  File: {filename}")
     return pages
 
@@ -491,6 +1559,11 @@ def get_subtable_tabs(table_info: ti.TableInfoDataClass):
     return result
 
 
+def get_subtable_ids(table_info: ti.TableInfoDataClass):
+    """Retrieve the table ids of all subtables from a given TableInfoDataClass."""
+    return [subtable_info.table_id for subtable_info in table_info.subtables.values()]
+
+
 # pylint: disable=W0612 # redfined-outer-name
 def process_all_subtables(table_name, table_info: ti.TableInfoDataClass, pages):
     """
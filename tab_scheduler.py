@@ -0,0 +1,412 @@
+"""
+Scheduler that keeps a number of browser tabs loading and harvests each one as
+soon as it has finished.
+
+Tabs are opened up to the tab count, then polled: a tab is read as soon as its
+`document.readyState` is "complete", closed, and its slot is refilled with the
+next job at once, so one slow page does not hold up the others. Each tab is
+mapped back to its job by its window handle, so a redirected url does not lose
+the job. A tab that has not finished loading after `tab_timeout` seconds is
+closed and its job tried again, up to `max_attempts` times.
+
+The number of tabs is tuned while it runs by a `TabCountTuner`, from the pages
+per second, the tab load time and the memory left.
+
+The browser runs with the "none" page load strategy while the scheduler runs
+(it is restarted with it if needed), so checking a tab that is still loading
+does not wait for it. A tab that times out anyway is failed on its own.
+
+A tab showing the login page means the session expired: the scheduler logs in
+again (`st.relogin`) and tries the job again. If the browser stops responding
+it is restarted by the `BrowserSupervisor`, and the jobs in flight are tried
+again.
+
+Usage Example:
+    >>> tuner = TabCountTuner(min_tabs=2, max_tabs=40)
+    >>> scheduler = TabScheduler(tuner, limiter, supervisor)
+    >>> jobs = [TabJob(url, link) for url, link in urls_and_links]
+    >>> failed = scheduler.run(jobs, read_page, save_page)
+"""
+
+from collections import deque
+from dataclasses import dataclass
+import time
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+import scrape_tools as st
+
+logger = st.logger
+
+
+@dataclass
+class TabJob:
+    """A page to open in a tab.
+
+    Attributes:
+        url (str): The url to open.
+        item: Whatever the caller needs to save the page, eg. the link.
+        attempts (int): The times the page has been opened.
+    """
+
+    url: str
+    item: object = None
+    attempts: int = 0
+
+
+@dataclass
+class _Tab:
+    """A tab in flight."""
+
+    job: TabJob
+    opened_at: float
+    login_count: int  # st.login_count when opened, for st.relogin.
+
+
+class TabCountTuner:
+    """Tunes the number of tabs loading at once while the pages are captured.
+
+    Every `interval` seconds the window's pages per second, tab load time and
+    memory are measured, and the tab count is changed:
+    - down by a quarter when the browser is near `max_browser_rss`, the system
+      has less than `min_free_memory` left, the tabs take more than
+      `max_latency` to load, or tabs time out. After a system memory shortage
+      the count is not raised again to where it happened, until `reset`.
+      The browser memory grows with the pages it has loaded whatever the tab
+      count, and the supervisor clears it with a restart, so it only lowers
+      the count.
+    - otherwise up or down by a quarter while that raises the pages per
+      second, turning back when it falls, and kept when it does not change.
+    Each result and its reason is logged.
+
+    Attributes:
+        min_tabs (int): The fewest tabs.
+        max_tabs (int): The most tabs.
+        tab_count (int): The current number of tabs.
+        max_latency (float): Seconds a tab may take to load on average.
+        max_browser_rss (int): Browser memory (bytes) to stay under. The
+            count is lowered at 80% of it, before the supervisor restarts the
+            browser at all of it.
+        min_free_memory (int): System memory (bytes) to leave available.
+        interval (float): Seconds between changes.
+    """
+
+    def __init__(
+        self,
+        min_tabs=2,
+        max_tabs=40,
+        initial_tabs=8,
+        max_latency=30,
+        max_browser_rss=2 * 1024 * 1024 * 1024,
+        min_free_memory=512 * 1024 * 1024,
+        interval=15,
+    ):
+        if not 1 <= min_tabs <= max_tabs:
+            raise ValueError(
+                f"min_tabs ({min_tabs}) must be from 1 to max_tabs ({max_tabs})."
+            )
+        self.min_tabs = min_tabs
+        self.max_tabs = max_tabs
+        self.tab_count = min(max_tabs, max(min_tabs, initial_tabs))
+        self.max_latency = max_latency
+        self.max_browser_rss = max_browser_rss
+        self.min_free_memory = min_free_memory
+        self.interval = interval
+        self.__ceiling = max_tabs  # Lowered when memory runs short.
+        self.__direction = 1
+        self.__last_rate = None
+        self.__start_window()
+
+    def reset(self):
+        """Starts tuning afresh, eg. after the browser was restarted with fresh
+        memory: the count may rise to max_tabs again."""
+        self.__ceiling = self.max_tabs
+        self.__direction = 1
+        self.__last_rate = None
+        self.__start_window()
+
+    def get_tab_count(self):
+        """Returns the number of tabs to keep loading, tuning it when due."""
+        if time.time() - self.__window_start >= self.interval:
+            self.__tune()
+        return self.tab_count
+
+    def record(self, latency, is_error=False):
+        """Records a tab: its load time, or is_error if it timed out."""
+        if is_error:
+            self.__errors += 1
+            return
+        self.__pages += 1
+        self.__latency_total += latency
+
+    def __start_window(self):
+        """Starts measuring a new window."""
+        self.__window_start = time.time()
+        self.__pages = 0
+        self.__errors = 0
+        self.__latency_total = 0
+
+    def __tune(self):
+        """Changes the tab count from the window's measurements."""
+        rate = self.__pages / (time.time() - self.__window_start)
+        latency = self.__latency_total / self.__pages if self.__pages else 0
+        rss = st.get_browser_rss()
+        available = st.get_available_memory()
+        step = max(1, self.tab_count // 4)
+
+        new_count = self.tab_count
+        if rss > 0.8 * self.max_browser_rss:
+            reason = f"browser memory {rss / 1024 / 1024:.0f} MB"
+            new_count -= step
+        elif available is not None and available < self.min_free_memory:
+            reason = f"free memory {available / 1024 / 1024:.0f} MB"
+            new_count -= step
+            self.__ceiling = max(self.min_tabs, self.tab_count - 1)
+        elif latency > self.max_latency:
+            reason = f"tab load time {latency:.1f} s"
+            new_count -= step
+        elif self.__errors:
+            reason = f"{self.__errors} tabs timed out"
+            new_count -= step
+        elif self.__last_rate is None or rate > self.__last_rate * 1.05:
+            reason = "pages per second rising"
+            new_count += step * self.__direction
+        elif rate < self.__last_rate * 0.95:
+            reason = "pages per second falling"
+            self.__direction = -self.__direction
+            new_count += step * self.__direction
+        else:
+            reason = "pages per second steady"
+        new_count = min(self.__ceiling, max(self.min_tabs, new_count))
+
+        logger.info(
+            "Tabs %s -> %s (%s): %.2f pages/s, load time %.1f s, browser %.0f MB.",
+            self.tab_count,
+            new_count,
+            reason,
+            rate,
+            latency,
+            rss / 1024 / 1024,
+        )
+        if new_count == self.min_tabs or new_count == self.__ceiling:
+            self.__direction = 1 if new_count == self.min_tabs else -1
+        self.tab_count = new_count
+        self.__last_rate = rate
+        self.__start_window()
+
+
+class TabScheduler:
+    """Keeps the tuner's number of tabs loading and harvests them as they finish.
+
+    Attributes:
+        tuner (TabCountTuner): Gives the number of tabs to keep open, read
+            before each tab is opened, and is told how each tab went.
+        limiter (AdaptiveLimiter): Told the load time of each tab, and about the
+            tabs that timed out or showed the login page.
+        supervisor (BrowserSupervisor): Restarts the browser when it is worn out
+            or stops responding.
+        tab_timeout (float): Seconds a tab may take to load before it is closed.
+        max_attempts (int): The most times a job is opened.
+        poll_interval (float): Seconds to wait when no tab has finished.
+        check_interval (float): Seconds between the supervisor's browser checks.
+        pages (int): The pages harvested.
+    """
+
+    def __init__(
+        self,
+        tuner,
+        limiter,
+        supervisor,
+        tab_timeout=60,
+        max_attempts=2,
+        poll_interval=0.2,
+        check_interval=10,
+    ):
+        self.tuner = tuner
+        self.limiter = limiter
+        self.supervisor = supervisor
+        self.tab_timeout = tab_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.check_interval = check_interval
+        self.pages = 0
+        self.__queue = deque()
+        self.__tabs = {}  # window handle -> _Tab
+        self.__failed = []
+        self.__main_handle = None
+        self.__last_check = 0
+        self.__restarts = supervisor.restarts
+
+    def run(self, jobs, read_page, save_page):
+        """Opens the jobs in tabs and saves each page when it has loaded.
+
+        Args:
+            jobs (list): The TabJob to open.
+            read_page (callable): Called as read_page(job) with the job's tab
+                current, returns the page html.
+            save_page (callable): Called as save_page(job, html_content).
+
+        Returns:
+            list: The TabJob that failed after max_attempts.
+        """
+        self.__queue.extend(jobs)
+        self.__failed = []
+        page_load_strategy = st.page_load_strategy
+        self.__set_page_load_strategy("none")
+        self.__main_handle = st.driver.window_handles[0]
+        try:
+            while self.__queue or self.__tabs:
+                try:
+                    self.__check_browser()
+                    self.__check_restarts()
+                    self.__fill()
+                    if not self.__harvest(read_page, save_page):
+                        time.sleep(self.poll_interval)
+                except WebDriverException as e:
+                    # The browser stopped responding: restart it, reopen the tabs.
+                    self.supervisor.restart(f"not responding ({type(e).__name__})")
+                    self.__requeue_tabs(is_attempt=True)
+            st.driver.switch_to.window(self.__main_handle)
+        finally:
+            self.__set_page_load_strategy(page_load_strategy)
+        return self.__failed
+
+    def __set_page_load_strategy(self, strategy):
+        """Restarts the browser with another page load strategy, if it differs."""
+        if st.page_load_strategy == strategy:
+            return
+        st.page_load_strategy = strategy
+        self.supervisor.restart(f"page load strategy '{strategy}'")
+        self.__main_handle = st.driver.window_handles[0]
+
+    def __fill(self):
+        """Opens tabs for the next jobs until there are get_tab_count()."""
+        while self.__queue and len(self.__tabs) < self.tuner.get_tab_count():
+            job = self.__queue.popleft()
+            job.attempts += 1
+            try:
+                st.driver.switch_to.window(self.__main_handle)
+                handles = set(st.driver.window_handles)
+                # Blocking is set per tab, so it must be set before the url loads.
+                url = "about:blank" if st.resource_blocking else job.url
+                st.driver.execute_script("window.open(arguments[0]);", url)
+                new_handles = set(st.driver.window_handles) - handles
+                if len(new_handles) != 1:
+                    raise WebDriverException(f"Could not open a tab for {job.url}")
+                handle = new_handles.pop()
+            except WebDriverException:
+                self.__retry(job, "could not be opened")
+                raise
+            self.__tabs[handle] = _Tab(job, time.time(), st.login_count)
+            if st.resource_blocking:
+                try:
+                    st.driver.switch_to.window(handle)
+                    st.apply_resource_blocking()
+                    st.driver.execute_script(
+                        "window.location.href = arguments[0];", job.url
+                    )
+                except TimeoutException:
+                    self.__drop(handle, "timed out opening")
+
+    def __harvest(self, read_page, save_page):
+        """Saves the tabs that have finished loading, and drops the stuck ones.
+
+        Returns:
+            int: The number of tabs closed.
+        """
+        closed = 0
+        for handle, tab in list(self.__tabs.items()):
+            elapsed = time.time() - tab.opened_at
+            try:
+                st.driver.switch_to.window(handle)
+                # A tab opened blank, to set the blocking, may not have navigated.
+                state = st.driver.execute_script(
+                    "return location.href == 'about:blank' ? 'blank'"
+                    " : document.readyState;"
+                )
+                if state != "complete":
+                    if elapsed > self.tab_timeout:
+                        self.__drop(handle, f"not loaded after {elapsed:.0f} s")
+                        closed += 1
+                    continue
+                html_content = read_page(tab.job)
+            except TimeoutException:
+                # Only this tab is stuck, the browser still responds.
+                self.__drop(handle, f"timed out after {elapsed:.0f} s")
+                closed += 1
+                continue
+            self.__close(handle)
+            closed += 1
+            if st.is_login_page(html_content):
+                # The session expired: the tab shows or was redirected to login.
+                self.limiter.record(elapsed, is_error=True)
+                st.relogin(tab.login_count)
+                self.__retry(tab.job, "showed the login page")
+                continue
+            self.limiter.record(elapsed)
+            self.tuner.record(elapsed)
+            self.supervisor.count_pages()
+            self.pages += 1
+            save_page(tab.job, html_content)
+        return closed
+
+    def __close(self, handle):
+        """Closes a tab and goes back to the main tab."""
+        st.driver.switch_to.window(handle)
+        st.driver.close()
+        st.driver.switch_to.window(self.__main_handle)
+        del self.__tabs[handle]
+
+    def __drop(self, handle, reason):
+        """Closes a tab that did not load, and tries its job again."""
+        tab = self.__tabs.pop(handle)
+        elapsed = time.time() - tab.opened_at
+        self.limiter.record(elapsed, is_error=True)
+        self.tuner.record(elapsed, is_error=True)
+        self.__retry(tab.job, reason)
+        try:
+            st.driver.switch_to.window(handle)
+            st.driver.close()
+        except TimeoutException:
+            logger.warning("Could not close a stuck tab: %s", tab.job.url)
+        st.driver.switch_to.window(self.__main_handle)
+
+    def __retry(self, job, reason):
+        """Queues the job again, or fails it after max_attempts."""
+        if job.attempts >= self.max_attempts:
+            logger.error(
+                "Tab failed (%s) after %s tries: %s", reason, job.attempts, job.url
+            )
+            self.__failed.append(job)
+            return
+        logger.warning("Tab %s, trying again: %s", reason, job.url)
+        self.__queue.append(job)
+
+    def __requeue_tabs(self, is_attempt):
+        """Queues the jobs of all the tabs in flight, eg. after a restart.
+
+        Args:
+            is_attempt (bool): Whether the lost tabs count as attempts.
+        """
+        tabs, self.__tabs = list(self.__tabs.values()), {}
+        for tab in tabs:
+            if is_attempt:
+                self.__retry(tab.job, "lost in a browser restart")
+            else:
+                tab.job.attempts -= 1
+                self.__queue.appendleft(tab.job)
+        self.__main_handle = st.driver.window_handles[0]
+
+    def __check_restarts(self):
+        """Resets the tuner when the browser was restarted, with fresh memory."""
+        if self.supervisor.restarts != self.__restarts:
+            self.__restarts = self.supervisor.restarts
+            self.tuner.reset()
+
+    def __check_browser(self):
+        """Lets the supervisor recycle the browser every check_interval seconds."""
+        if time.time() - self.__last_check < self.check_interval:
+            return
+        self.__last_check = time.time()
+        if self.supervisor.check():
+            self.__requeue_tabs(is_attempt=False)
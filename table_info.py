@@ -46,6 +46,20 @@ class TableInfoDataClass:
         subtables (Optional[Dict[str, "TableInfoDataClass"]], optional):
             A dict of child TableInfoDataClass objects representing
             sub-tables.
+        page_param (str, optional): The URL query parameter for the list page
+            number, used to fetch the list pages concurrently over HTTP.
+            Empty to always follow the "Next" link.
+        date_window_months (int, optional): For lists with a ListStartDate /
+            ListEndDate range in url_path, the number of months per date
+            window when crawling the windows concurrently over HTTP. 0 to
+            crawl the whole range at once.
+        search_by (str, optional): The list search field used to look up
+            records by transaction number.
+        download_segment_threshold (int, optional): Attachments larger than
+            this many bytes are downloaded as parallel byte ranges. 0 to
+            always use a single stream.
+        download_segments (int, optional): Number of parallel byte ranges
+            for large attachments.
     """
 
     table_id: str
@@ -61,6 +75,11 @@ class TableInfoDataClass:
     # File Download info
     files_table_url_form: str = ""
     table_url_form_id_name: str = "ID"
+    page_param: str = "page"
+    date_window_months: int = 0
+    search_by: str = "TransactionNumber^alpha"
+    download_segment_threshold: int = 20 * 1024 * 1024
+    download_segments: int = 4
 
 
 table_info: Dict[str, TableInfoDataClass] = {}
@@ -110,6 +129,7 @@ table_info["supplier_invoices"] = TableInfoDataClass(
     files_table_url_form=(
         "fileupload/cUpload.aspx?TransactionID={id}&Source=SIPL_Files&POID={id_2}"
     ),
+    date_window_months=1,
 )
 
 table_info["items"] = TableInfoDataClass(
@@ -160,6 +180,7 @@ table_info["salesorders"] = TableInfoDataClass(
         "fileupload/cUpload.aspx?TransactionID={id}&"
         "Source=SaleOrder&PresaleID=0&SageOrHausProAPI="
     ),
+    date_window_months=1,
 )
 
 
@@ -181,6 +202,7 @@ table_info["quotes"] = TableInfoDataClass(
         "fileupload/cUpload.aspx?TransactionID={id}&"
         "Source=Presale&SubSource=Quote&OpportunityID={id_2}"
     ),
+    date_window_months=1,
 )
 
 
@@ -211,6 +233,7 @@ table_info["opportunities"] = TableInfoDataClass(
         "fileupload/cUpload.aspx?TransactionID={id}&"
         "Source=Presale&SubSource=Opportunity"
     ),
+    date_window_months=1,
 )
 
 